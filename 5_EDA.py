@@ -131,7 +131,13 @@ Created on Sun Feb  2 20:29:27 2020
 ## Import Files
 import json
 import pandas as pd
-import xml.etree.ElementTree as et
+from ntsb_aggregates import aggregate_cache, cached, dataset_version
+from ntsb_cohorts import cohort_table
+from ntsb_data import data_version, load_aviation_data
+from ntsb_geo import geo_index, within_box, within_radius
+from ntsb_narratives import extract_records, narrative_cols
+from ntsb_cube import time_cube, time_series
+from ntsb_stats import fatality_rates
 import numpy as np
 import seaborn as sns #visualisation
 import matplotlib
@@ -145,15 +151,10 @@ import matplotlib.pyplot as plt
 ## label file path
 path_to_xml_file = "./data/AviationData.xml"
 
-# Load xml file data
-tree = et.parse(path_to_xml_file)
-data = []
-for el in tree.iterfind('./*'):
-    for i in el.iterfind('*'):
-        data.append(dict(i.items()))
-
-##create pandas dataframe to hold data
-xml_df = pd.DataFrame(data)
+# Load xml file data into a pandas dataframe, streaming the rows
+# (shared loader, see ntsb_data.py). The cleaned dataframe is cached
+# as parquet in ./data/cache, so only the first run parses the XML.
+xml_df = load_aviation_data(path_to_xml_file)
 
 
 ###########################################################
@@ -164,34 +165,9 @@ xml_df = pd.DataFrame(data)
 with open('./data/NarrativeData_499.json') as f:
   data = json.load(f)
   
-#function to extract json values and create field lists
-def extract_values(obj, key):
-    """Pull all values of specified key from nested JSON."""
-    arr = []
-
-    def extract(obj, arr, key):
-        """Recursively search for values of key in JSON tree."""
-        if isinstance(obj, dict):
-            for k, v in obj.items():
-                if isinstance(v, (dict, list)):
-                    extract(v, arr, key)
-                elif k == key:
-                    arr.append(v)
-        elif isinstance(obj, list):
-            for item in obj:
-                extract(item, arr, key)
-        return arr
-
-    results = extract(obj, arr, key)
-    return results
-
-#field lists for each set of json values
-Event_ID = extract_values(data, 'EventId')
-narrative = extract_values(data, 'narrative')
-cause = extract_values(data, 'probable_cause')
-
-#combine lists into a pandas dataframe
-json_df = pd.DataFrame(list(zip(Event_ID,narrative,cause)), columns= ["Event_ID", "Narrative", "Cause"])
+#pull the EventId, narrative and probable cause out of each record
+#(a missing field is left as None), and combine into a pandas dataframe
+json_df = pd.DataFrame(list(extract_records(data)), columns= narrative_cols)
 
 ###########################################################
 ### Data Cleaning
@@ -209,21 +185,9 @@ print(len(xml_df[xml_df["InvestigationType"]=='Incident']))
 ## want to confirm by cross referencing with narratives. (if time)
 
 
-# Turn blanks to 0 for fatalities, make int
-xml_df['TotalFatalInjuries'] = xml_df['TotalFatalInjuries'].replace({'':'0'})
-xml_df['TotalFatalInjuries'] = xml_df['TotalFatalInjuries'].astype(int)
-
-# Turn blanks to 0 for serious injuries, make int
-xml_df['TotalSeriousInjuries'] = xml_df['TotalSeriousInjuries'].replace({'':'0'})
-xml_df['TotalSeriousInjuries'] = xml_df['TotalSeriousInjuries'].astype(int)
-
-# Turn blanks to 0 for minor injuries, make int
-xml_df['TotalMinorInjuries'] = xml_df['TotalMinorInjuries'].replace({'':'0'})
-xml_df['TotalMinorInjuries'] = xml_df['TotalMinorInjuries'].astype(int)
-
-# Turn blanks to 0 for unijured, make int
-xml_df['TotalUninjured'] = xml_df['TotalUninjured'].replace({'':'0'})
-xml_df['TotalUninjured'] = xml_df['TotalUninjured'].astype(int)
+# Blanks are turned to 0 for fatalities, serious injuries, minor
+# injuries and uninjured, and made int, when the data is loaded
+# (clean_aviation_df in ntsb_data.py)
 
 
 
@@ -241,6 +205,13 @@ for i in stats:
 #print(xml_df == '').sum(axis=0) # no blank values?....doesnt seem right
 xml_df=xml_df.replace(r'^\s*$', np.nan, regex=True)
 
+# The statistics below (fatality rates, the time cube) are cached in
+# ./data/cache/aggregates (see ntsb_aggregates.py), and only worked out
+# again when the XML or a narrative file changes. They are taken from
+# xml_df with the blanks made NaN, so a blank isn't counted as a value.
+cohorts = cohort_table(xml_df, data_version(path_to_xml_file))
+aggs = aggregate_cache(cohorts, dataset_version(path_to_xml_file, "./data"))
+
 # see how many missing values there are
 print(xml_df.isnull().sum())   
 
@@ -401,8 +372,11 @@ print(xml_df["InjurySeverity"].unique())
  'Fatal(31)' 'Fatal(135)' 'Fatal(78)']
 
 ## divided into fatal and non fatal injuries
-non_fatal = xml_df[xml_df["InjurySeverity"].str.contains("Fatal\(")==False]
-fatal = xml_df[xml_df["InjurySeverity"].str.contains("Fatal\(")]
+## (Fatality_bin is parsed from InjurySeverity once, when the data is
+## loaded: "Fatal" for Fatal(n), "Non-Fatal" otherwise, and NaN if blank.
+## Fatality_count holds the n, see add_fatality_cols in ntsb_data.py)
+non_fatal = xml_df[xml_df["Fatality_bin"]=="Non-Fatal"]
+fatal = xml_df[xml_df["Fatality_bin"]=="Fatal"]
 
 num_fatal = len(fatal)  #15409 Fatal
 num_non_fatal= len(non_fatal) - num_inc #61848 - 2050 = 58798
@@ -415,10 +389,6 @@ per_non_fatal = num_non_fatal/num_acc #79%
 # This appears to be a useful outcome variable, so going to look
 # at types of planes/flights with fatal vs non fatal accidents
 
-xml_df["Fatality_bin"] = np.nan
-xml_df['Fatality_bin'].loc[xml_df['InjurySeverity'].str.contains("Fatal\(")==False] = "Non-Fatal"
-xml_df['Fatality_bin'].loc[xml_df['InjurySeverity'].str.contains("Fatal\(")==True] = "Fatal"
-
 xml_df["Fatality_bin"].head(15)
 mod_df =xml_df[xml_df["Fatality_bin"].notnull()]
 
@@ -525,7 +495,7 @@ Name: TotalSeriousInjuries, dtype: object
 ## calculate most serious injuries
 print(max(xml_df["TotalSeriousInjuries"].unique())) # 111
 ## average number of serious injuries
-print(xml_df[xml_df["TotalSeriousInjuries"] >0].mean()) # 1.5 (of those with serious injuries), on these fewer than 1 fatality on avg
+print(xml_df.loc[xml_df["TotalSeriousInjuries"] >0, ["TotalSeriousInjuries", "TotalFatalInjuries"]].mean()) # 1.5 (of those with serious injuries), on these fewer than 1 fatality on avg
 ## most frequent number of serious injuries
 print(xml_df["TotalSeriousInjuries"][xml_df["TotalSeriousInjuries"] >0].mode()) # 1
 len(xml_df["TotalSeriousInjuries"][xml_df["TotalSeriousInjuries"]==1]) #7794 single serious injuries
@@ -566,6 +536,15 @@ Name: TotalUninjured, dtype: object
 ###########################################################
 ############################################################
 
+## Fatal and non-fatal accident counts, percent fatal and a 95% confidence
+## interval for each value of the predictors below, all counted in one
+## pass (see fatality_rates in ntsb_stats.py)
+predictors = ["NumberOfEngines", "AmateurBuilt", "InvestigationType",
+              "AircraftCategory", "EngineType", "FARDescription", "Schedule",
+              "WeatherCondition", "BroadPhaseOfFlight"]
+rates = cached(aggs, "known_outcome", fatality_rates, predictors)
+print(rates)
+
 ##### Continuous Variables (1) ############################
 
 
@@ -575,8 +554,7 @@ Name: TotalUninjured, dtype: object
 sns.catplot(x="NumberOfEngines", y="TotalFatalInjuries", kind="bar", data=mod_df)
 sns.catplot(x="NumberOfEngines", y="TotalFatalInjuries", kind="box", data=mod_df)
 
-print(mod_df[mod_df["Fatality_bin"]=="Fatal"].groupby("NumberOfEngines")['Fatality_bin'].count())
-print(mod_df[mod_df["Fatality_bin"]=="Non-Fatal"].groupby("NumberOfEngines")['Fatality_bin'].count())
+print(rates.loc["NumberOfEngines"])
 
 #0	155	977	1132	14%
 #1	11314	50151	61465	18%
@@ -608,8 +586,7 @@ sns.catplot(x="NumberOfEngines", y="TotalFatalInjuries", kind="swarm", data=mod_
 
 sns.catplot(x="AmateurBuilt", y="TotalFatalInjuries", kind="bar", data=mod_df, stacked=True)
 
-print(mod_df[mod_df["Fatality_bin"]=="Fatal"].groupby("AmateurBuilt")['Fatality_bin'].count())
-print(mod_df[mod_df["Fatality_bin"]=="Non-Fatal"].groupby("AmateurBuilt")['Fatality_bin'].count())
+print(rates.loc["AmateurBuilt"])
 
 #AmateurBuilt Fatal	Amateur Built Non-Fatal	Total	% Fatal
 #13103	56095	69198	19%
@@ -644,8 +621,7 @@ Name: AmateurBuilt, dtype: object
 
 sns.catplot(x="InvestigationType", y="TotalFatalInjuries", kind="bar", data=mod_df)
 
-print(mod_df[mod_df["Fatality_bin"]=="Fatal"].groupby("InvestigationType")['Fatality_bin'].count())
-print(mod_df[mod_df["Fatality_bin"]=="Non-Fatal"].groupby("InvestigationType")['Fatality_bin'].count())
+print(rates.loc["InvestigationType"])
 
 # All fatalities were due to accidents, no incidents led to fatalities
 
@@ -663,8 +639,7 @@ Name: InvestigationType, dtype: object
 
 #sns.catplot(x="AircraftCategory", y="TotalFatalInjuries", kind="bar", data=mod_df)
 
-print(mod_df[mod_df["Fatality_bin"]=="Fatal"].groupby("AircraftCategory")['Fatality_bin'].count())
-print(mod_df[mod_df["Fatality_bin"]=="Non-Fatal"].groupby("AircraftCategory")['Fatality_bin'].count())
+print(rates.loc["AircraftCategory"])
 
 '''	Fatal	Nonfatal	Total	% Fatal
 Airplane	3067	11143	14210	22%
@@ -697,8 +672,7 @@ Name: EngineType, dtype: object
 '''
 #sns.catplot(x="EngineType", y="TotalFatalInjuries", kind="bar", data=mod_df)
 
-print(mod_df[mod_df["Fatality_bin"]=="Fatal"].groupby("EngineType")['Fatality_bin'].count())
-print(mod_df[mod_df["Fatality_bin"]=="Non-Fatal"].groupby("EngineType")['Fatality_bin'].count())
+print(rates.loc["EngineType"])
 '''
 	Fatal	Non-fatal	total	percentage
 Hybrid Rocket           1	1		1	100%
@@ -718,8 +692,7 @@ Unknown               450	450	1,613	2,063	22%
 
 sns.catplot(x="FARDescription", y="TotalFatalInjuries", kind="bar", data=mod_df)
 
-print(mod_df[mod_df["Fatality_bin"]=="Fatal"].groupby("FARDescription")['Fatality_bin'].count())
-print(mod_df[mod_df["Fatality_bin"]=="Non-Fatal"].groupby("FARDescription")['Fatality_bin'].count())
+print(rates.loc["FARDescription"])
 '''
 count     77257
 unique       17
@@ -746,8 +719,7 @@ Unknown                                78	78	94	172	45%
 
 sns.catplot(x="Schedule", y="TotalFatalInjuries", kind="bar", data=mod_df)
 
-print(mod_df[mod_df["Fatality_bin"]=="Fatal"].groupby("Schedule")['Fatality_bin'].count())
-print(mod_df[mod_df["Fatality_bin"]=="Non-Fatal"].groupby("Schedule")['Fatality_bin'].count())
+print(rates.loc["Schedule"])
 '''
 NSCH   	970	2844	3814	25.43%
 SCHD    	304	3162	3466	8.77%
@@ -772,8 +744,7 @@ Name: PurposeOfFlight, dtype: object
 
 sns.catplot(x="WeatherCondition", y="TotalFatalInjuries", kind="bar", data=mod_df)
 
-print(mod_df[mod_df["Fatality_bin"]=="Fatal"].groupby("WeatherCondition")['Fatality_bin'].count())
-print(mod_df[mod_df["Fatality_bin"]=="Non-Fatal"].groupby("WeatherCondition")['Fatality_bin'].count())
+print(rates.loc["WeatherCondition"])
 '''
 IMC     	3242	2338	5580	58.10%
 UNK      	474	450	924	51.30%
@@ -797,8 +768,7 @@ Name: BroadPhaseOfFlight, dtype: object
 
 sns.catplot(x="BroadPhaseOfFlight", y="TotalFatalInjuries", kind="bar", data=mod_df)
 
-print(mod_df[mod_df["Fatality_bin"]=="Fatal"].groupby("BroadPhaseOfFlight")['Fatality_bin'].count())
-print(mod_df[mod_df["Fatality_bin"]=="Non-Fatal"].groupby("BroadPhaseOfFlight")['Fatality_bin'].count())
+print(rates.loc["BroadPhaseOfFlight"])
 '''
 APPROACH	1838	5672	7510	24%
 CLIMB	669	1556	2225	30%
@@ -883,6 +853,21 @@ Name: AirportCode, dtype: object
 ###################################### P17) Longitude
 
 # TODO: convert lat and long to geopandas
+## Latitude and Longitude are parsed to floats when the data is loaded
+## (parse_coordinates in ntsb_data.py), and the rows with coordinates are
+## indexed with a KD-tree (see ntsb_geo.py), so the accidents near a
+## point or inside a box are found without checking every row
+geo = geo_index(xml_df)
+print("{} records have coordinates".format(len(geo["rows"])))
+
+# accidents within 50 km of Anchorage, AK (the most common Location)
+near_anchorage = xml_df.iloc[within_radius(geo, 61.2181, -149.9003, 50)]
+print(len(near_anchorage))
+
+# accidents inside a box around Brazil, with their EventIds to join to
+# the narratives
+brazil_box = xml_df.iloc[within_box(geo, -34, -74, 6, -34)]
+print(brazil_box[["EventId", "Country", "Latitude", "Longitude"]].head())
 
 '''
 count             77257
@@ -923,3 +908,22 @@ top
 freq      13188
 Name: PublicationDate, dtype: object
 '''
+
+## EventDate and PublicationDate are parsed to datetime64 when the data is
+## loaded (parse_dates in ntsb_data.py), blanks become NaT
+print(xml_df[["EventDate", "PublicationDate"]].describe())
+
+## accidents and fatal accidents by year x month x FARDescription x
+## AircraftCategory x Country are counted once into a cube (see
+## ntsb_cube.py), and the time series below are read from it
+cube = cached(aggs, None, time_cube)
+
+# accidents per year, and the share that were fatal
+print(time_series(cube, "year"))
+
+# by month of the year, are there more accidents in the summer?
+print(time_series(cube, "month").groupby("month")[["events", "fatal"]].sum())
+
+# non-US non-commercial helicopter accidents per year
+print(time_series(cube, "year", FARDescription="Non-U.S., Non-Commercial",
+                  AircraftCategory="Helicopter"))
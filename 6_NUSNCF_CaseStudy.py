@@ -77,7 +77,12 @@ Created on Wed Feb  5 19:46:24 2020
 ## Import Files
 import json
 import pandas as pd
-import xml.etree.ElementTree as et
+from ntsb_aggregates import aggregate, aggregate_cache, dataset_version
+from ntsb_cohorts import cohort, cohort_table
+from ntsb_cube import rollup, update_drill_cube
+from ntsb_data import data_version, load_aviation_data
+from ntsb_makes import add_canonical_make_model
+from ntsb_stats import categorical_report, profile_columns, write_profile
 import numpy as np
 import seaborn as sns #visualisation
 import matplotlib
@@ -95,15 +100,34 @@ pd.set_option('display.max_columns',500)
 ## label file path
 path_to_xml_file = "./data/AviationData.xml"
 
-# Load xml file data
-tree = et.parse(path_to_xml_file)
-data = []
-for el in tree.iterfind('./*'):
-    for i in el.iterfind('*'):
-        data.append(dict(i.items()))
+# Load xml file data into a pandas dataframe, streaming the rows
+# (shared loader, see ntsb_data.py). The cleaned dataframe is cached
+# as parquet in ./data/cache, so only the first run parses the XML.
+xml_df = load_aviation_data(path_to_xml_file)
 
-##create pandas dataframe to hold data
-xml_df = pd.DataFrame(data)
+# The same Make / Model is spelled several ways ("CESSNA" and "Cessna",
+# "PA-34" and "PA34", "R44" and "R44 - II"). Add Make_canonical and
+# Model_canonical columns, from a lookup table of the distinct values
+# saved in ./data/cache/make_model.parquet (see ntsb_makes.py).
+xml_df = add_canonical_make_model(xml_df)
+
+# Counts, fatal accidents and injury totals by FARDescription x
+# AircraftCategory x Country x Make x Model x PurposeOfFlight, added up
+# once and saved in ./data/cache/drill_cube.parquet (see ntsb_cube.py).
+# The drill-downs below can be read from it with rollup.
+version = data_version(path_to_xml_file)
+drill = update_drill_cube(xml_df, version)
+
+# The groups of the case study (nuncf, nuncf_heli, brazil_heli, ...) are
+# defined once in ntsb_cohorts.py, and shared with the other scripts.
+# Their rows are worked out the first time each is asked for, and saved
+# in ./data/cache/cohorts until the data changes.
+cohorts = cohort_table(xml_df, version)
+
+# Counts by Country, Make and Model of those cohorts are cached in
+# ./data/cache/aggregates (see ntsb_aggregates.py), and only worked out
+# again when the XML or a narrative file changes.
+aggs = aggregate_cache(cohorts, dataset_version(path_to_xml_file, "./data"))
 
 
 ###########################################################
@@ -122,21 +146,9 @@ print(len(xml_df[xml_df["InvestigationType"]=='Incident']))
 ## want to confirm by cross referencing with narratives. (if time)
 
 
-# Turn blanks to 0 for fatalities, make int
-xml_df['TotalFatalInjuries'] = xml_df['TotalFatalInjuries'].replace({'':'0'})
-xml_df['TotalFatalInjuries'] = xml_df['TotalFatalInjuries'].astype(int)
-
-# Turn blanks to 0 for serious injuries, make int
-xml_df['TotalSeriousInjuries'] = xml_df['TotalSeriousInjuries'].replace({'':'0'})
-xml_df['TotalSeriousInjuries'] = xml_df['TotalSeriousInjuries'].astype(int)
-
-# Turn blanks to 0 for minor injuries, make int
-xml_df['TotalMinorInjuries'] = xml_df['TotalMinorInjuries'].replace({'':'0'})
-xml_df['TotalMinorInjuries'] = xml_df['TotalMinorInjuries'].astype(int)
-
-# Turn blanks to 0 for unijured, make int
-xml_df['TotalUninjured'] = xml_df['TotalUninjured'].replace({'':'0'})
-xml_df['TotalUninjured'] = xml_df['TotalUninjured'].astype(int)
+# Blanks are turned to 0 for fatalities, serious injuries, minor
+# injuries and uninjured, and made int, when the data is loaded
+# (clean_aviation_df in ntsb_data.py)
 
 # create list of columns
 col = list(xml_df.columns)
@@ -150,6 +162,14 @@ print(col)
  'TotalUninjured', 'WeatherCondition', 'BroadPhaseOfFlight', 'ReportStatus', 
  'PublicationDate']
 
+## The text fields (Make, Model, Location, Country, FARDescription, etc)
+## are stored as pandas categoricals when the data is loaded. Report the
+## memory that saves, and the speedup on the groupings used below
+## (see categorical_report in ntsb_stats.py).
+cat_memory, cat_timing = categorical_report(xml_df)
+print(cat_memory)
+print(cat_timing)
+
 ###########################################################
 ### Quantifying this population in context
 ###########################################################
@@ -160,8 +180,8 @@ print(col)
 
 #create a dataset of all accidents, and a group for just non us non 
 # commercial flight aand incident ccident reoprts
-accidents = xml_df[xml_df["InvestigationType"]=="Accident"] #7420 Accidents
-nuncf = xml_df[xml_df["FARDescription"]=="Non-U.S., Non-Commercial"] #667
+accidents = cohort(cohorts, "accidents") #7420 Accidents
+nuncf = cohort(cohorts, "nuncf") #667
 ## 9% of Accidents are from this group
 
 print(accidents["TotalFatalInjuries"].sum()) #43995
@@ -294,7 +314,7 @@ print(nuncf["AircraftCategory"].unique())
 #['Helicopter' 'Airplane' '' 'Balloon']
 
 ## here we see the deadly impact of helicoptor flights in NUNCF
-print(nuncf[nuncf["AircraftCategory"]=="Helicopter"].sum())
+print(nuncf[nuncf["AircraftCategory"]=="Helicopter"].sum(numeric_only=True))
 print(len(nuncf[nuncf["AircraftCategory"]=="Helicopter"])) #153
 
 #TotalFatalInjuries                                271
@@ -305,7 +325,7 @@ print(len(nuncf[nuncf["AircraftCategory"]=="Helicopter"])) #153
 #61% of passengers in accidents died 271/443 passengers
 
 ## Compare to Airplanes
-print(nuncf[nuncf["AircraftCategory"]=="Airplane"].sum())
+print(nuncf[nuncf["AircraftCategory"]=="Airplane"].sum(numeric_only=True))
 print(len(nuncf[nuncf["AircraftCategory"]=="Airplane"])) #434
 
 #TotalFatalInjuries                               842
@@ -319,15 +339,17 @@ print(len(nuncf[nuncf["AircraftCategory"]=="Airplane"])) #434
 # Okay, so let's look at Non-US, Non-Commercial Helicopter Accidents
 
 # create a helicopter only dataset
-nuncf_heli = nuncf[nuncf["AircraftCategory"]=="Helicopter"]
-
-nuncf_heli = nuncf_heli[nuncf_heli["InvestigationType"]=="Accident"]
+nuncf_heli = cohort(cohorts, "nuncf_heli") # accidents only
 #Now we are looking at 150 records for this population
 
 
-# again review stats
-for i in col:
-    print(nuncf_heli[i].describe())
+# again review stats, count/unique/top/freq plus missing and blank values
+# for every column in one pass, next to the same stats for all records and
+# for all nuncf records (see profile_columns in ntsb_stats.py). The profile
+# is saved too, so it can be compared after a data refresh.
+profile = profile_columns(xml_df, {"nuncf": nuncf, "nuncf_heli": nuncf_heli})
+print(profile.loc["nuncf_heli"])
+write_profile(profile, "./data/cache/profile_nuncf.json")
 '''
 count                150
 unique               150
@@ -364,9 +386,12 @@ print(print(nuncf_heli["Country"].unique()))
 '''
 ### look at fataal accidents, total fatalities, and calculate % accidents that 
 ## are fatal
-print(nuncf_heli[nuncf_heli["TotalFatalInjuries"]>0].groupby('Country')["TotalFatalInjuries"].count().sort_values(ascending=False))
-print(nuncf_heli.groupby('Country')["TotalFatalInjuries"].sum().sort_values(ascending=False))
-print(nuncf_heli.groupby('Country')["EventId"].count().sort_values(ascending=False))
+fatal_heli_country = aggregate(aggs, {"base": "nuncf_heli", "where": [("TotalFatalInjuries", ">", 0)]},
+                               "Country", {"TotalFatalInjuries": "count"})
+heli_country = aggregate(aggs, "nuncf_heli", "Country", {"TotalFatalInjuries": "sum", "EventId": "count"})
+print(fatal_heli_country.sort_values("TotalFatalInjuries", ascending=False))
+print(heli_country.sort_values("TotalFatalInjuries", ascending=False))
+print(heli_country.sort_values("EventId", ascending=False))
 
 '''
 Country   Fatal_Accidents   Fatalities    Accidents    % Fatal
@@ -414,7 +439,7 @@ Israel                 1
 
 
 ## trim data more to just Brazil
-brazil_heli= nuncf_heli[nuncf_heli["Country"]=="Brazil"]
+brazil_heli = cohort(cohorts, "brazil_heli")
 
 print(brazil_heli["Make"].unique())
 
@@ -423,8 +448,9 @@ print(brazil_heli["Make"].unique())
 
 ## look at fatal accidents by make and model
 
-print(brazil_heli.groupby('Make')["TotalFatalInjuries"].count().sort_values(ascending=False))
-print(brazil_heli.groupby('Make')["EventId"].count().sort_values(ascending=False))
+brazil_heli_make = aggregate(aggs, "brazil_heli", "Make", {"TotalFatalInjuries": "count", "EventId": "count"})
+print(brazil_heli_make["TotalFatalInjuries"].sort_values(ascending=False))
+print(brazil_heli_make["EventId"].sort_values(ascending=False))
 
 '''
 Fatal Accidents by Make
@@ -441,7 +467,13 @@ print(brazil_heli["Model"].unique())
  'EMB-720']
 '''
 
-print(brazil_heli.groupby(['Make','Model'])["TotalFatalInjuries"].count().sort_values(ascending=False))
+print(aggregate(aggs, "brazil_heli", ['Make','Model'], {"TotalFatalInjuries": "count"}).sort_values("TotalFatalInjuries", ascending=False))
+print(aggregate(aggs, "brazil_heli", ['Make_canonical','Model_canonical'], {"TotalFatalInjuries": "count"}).sort_values("TotalFatalInjuries", ascending=False))
+
+## the same drill-down as a lookup in the cube, with the fatal accidents
+## and injury totals of each Make and Model
+print(rollup(drill, ['Make','Model'], FARDescription="Non-U.S., Non-Commercial",
+             AircraftCategory="Helicopter", Country="Brazil"))
 
 ### Robinson R44 comes up strong in the data- more than half of the 
 ### fatal accidents
@@ -469,7 +501,7 @@ print(brazil_heli["PurposeOfFlight"].unique())
  'Other Work Use']
 '''
 
-print(brazil_heli.groupby(['PurposeOfFlight','Make'])["TotalFatalInjuries"].count().sort_values(ascending=False))
+print(brazil_heli.groupby(['PurposeOfFlight','Make'], observed=True)["TotalFatalInjuries"].count().sort_values(ascending=False))
 '''
 Top # Fatal Accidents by Purpose and Make
 Unknown             ROBINSON    5
@@ -481,7 +513,7 @@ Instructional       ROBINSON    2
 ## Well Unknown could be rescues or something? But seems like
 # that theory may be shakey.
 
-print(brazil_heli.groupby(['BroadPhaseOfFlight'])["TotalFatalInjuries"].count().sort_values(ascending=False))
+print(brazil_heli.groupby(['BroadPhaseOfFlight'], observed=True)["TotalFatalInjuries"].count().sort_values(ascending=False))
 # Weather, Schedule, Phase of flight mostly unknown
 
 
@@ -490,12 +522,12 @@ print(brazil_heli.groupby(['BroadPhaseOfFlight'])["TotalFatalInjuries"].count().
 ############# Are Airplanes Similar to Helicopters?
 #############
 
-brazil = nuncf[nuncf["Country"]== 'Brazil']
+brazil = cohort(cohorts, "brazil")
 #110
 
 
 ## compare number of brazilian airplans to helicopters
-print(brazil.groupby(['AircraftCategory'])["EventId"].count().sort_values(ascending=False))
+print(brazil.groupby(['AircraftCategory'], observed=True)["EventId"].count().sort_values(ascending=False))
 
 #Accidents by type
 #AircraftCategory
@@ -504,8 +536,8 @@ print(brazil.groupby(['AircraftCategory'])["EventId"].count().sort_values(ascend
 
 ## cessnas also appear frequently- but they are one of the most popular
 ## personal aircraft models out there.
-brazil_air = nuncf[nuncf["AircraftCategory"]=="Airplane"]
-print(brazil_air.groupby(['PurposeOfFlight','Make'])["TotalFatalInjuries"].count().sort_values(ascending=False))
+brazil_air = cohort(cohorts, "brazil_air")
+print(brazil_air.groupby(['PurposeOfFlight','Make'], observed=True)["TotalFatalInjuries"].count().sort_values(ascending=False))
 '''
 Fatal Accidents by Purpose and Make
 PurposeOfFlight          Make                          
@@ -524,7 +556,7 @@ Business                 CESSNA                             8
 '''
   
 ## Cessna 172 may be an additional route to look into               
-print(brazil_air.groupby(['Make','Model'])["TotalFatalInjuries"].count().sort_values(ascending=False))
+print(brazil_air.groupby(['Make','Model'], observed=True)["TotalFatalInjuries"].count().sort_values(ascending=False))
 
 '''
 Make                            Model            
@@ -551,3 +583,6 @@ CESSNA                          T206H                 3
 PIPER                           PA28R                 3
 Cessna                          152                   3
 '''
+
+## the same breakdown with the spellings of each Make and Model combined
+print(brazil_air.groupby(['Make_canonical','Model_canonical'], observed=True)["TotalFatalInjuries"].count().sort_values(ascending=False))
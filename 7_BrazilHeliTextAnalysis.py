@@ -46,12 +46,17 @@ Created on Wed Feb  5 21:53:17 2020
 #### CODE ################################################
 ##########################################################
 ## Import Files
-import json
 import pandas as pd
-import xml.etree.ElementTree as et
-from nltk import word_tokenize
-from nltk.corpus import stopwords
-#nltk.download()
+from ntsb_cohorts import cohort, cohort_table
+from ntsb_data import data_version, load_aviation_data
+from ntsb_narratives import get_narratives, load_narratives
+from ntsb_text import (boilerplate_examples, learn_boilerplate, make_stop_words,
+                       term_document_matrix, tokenize_narratives, top_terms)
+from ntsb_duplicates import update_duplicate_groups
+from ntsb_features import keyness, subset_rows, top_tfidf, update_feature_store
+from ntsb_search import match_rate, search, update_search_index
+from ntsb_trends import term_trend, update_term_index
+#nltk.download('stopwords')
 import matplotlib
 matplotlib.use('agg')
 
@@ -67,15 +72,14 @@ pd.set_option('display.max_columns',500)
 ## label file path
 path_to_xml_file = "./data/AviationData.xml"
 
-# Load xml file data
-tree = et.parse(path_to_xml_file)
-data = []
-for el in tree.iterfind('./*'):
-    for i in el.iterfind('*'):
-        data.append(dict(i.items()))
+# Load xml file data into a pandas dataframe, streaming the rows
+# (shared loader, see ntsb_data.py). The cleaned dataframe is cached
+# as parquet in ./data/cache, so only the first run parses the XML.
+xml_df = load_aviation_data(path_to_xml_file)
 
-##create pandas dataframe to hold data
-xml_df = pd.DataFrame(data)
+# the groups below (nuncf, brazil_fatal, ...) are the shared cohorts of
+# ntsb_cohorts.py, their rows are saved in ./data/cache/cohorts
+cohorts = cohort_table(xml_df, data_version(path_to_xml_file))
 
 ###########################################################
 ### Data Cleaning
@@ -93,21 +97,9 @@ print(len(xml_df[xml_df["InvestigationType"]=='Incident']))
 ## want to confirm by cross referencing with narratives. (if time)
 
 
-# Turn blanks to 0 for fatalities, make int
-xml_df['TotalFatalInjuries'] = xml_df['TotalFatalInjuries'].replace({'':'0'})
-xml_df['TotalFatalInjuries'] = xml_df['TotalFatalInjuries'].astype(int)
-
-# Turn blanks to 0 for serious injuries, make int
-xml_df['TotalSeriousInjuries'] = xml_df['TotalSeriousInjuries'].replace({'':'0'})
-xml_df['TotalSeriousInjuries'] = xml_df['TotalSeriousInjuries'].astype(int)
-
-# Turn blanks to 0 for minor injuries, make int
-xml_df['TotalMinorInjuries'] = xml_df['TotalMinorInjuries'].replace({'':'0'})
-xml_df['TotalMinorInjuries'] = xml_df['TotalMinorInjuries'].astype(int)
-
-# Turn blanks to 0 for unijured, make int
-xml_df['TotalUninjured'] = xml_df['TotalUninjured'].replace({'':'0'})
-xml_df['TotalUninjured'] = xml_df['TotalUninjured'].astype(int)
+# Blanks are turned to 0 for fatalities, serious injuries, minor
+# injuries and uninjured, and made int, when the data is loaded
+# (clean_aviation_df in ntsb_data.py)
 
 col = list(xml_df.columns)
 print(col)
@@ -129,13 +121,13 @@ print(col)
 # 
 #create a dataset of all accidents, and a group for just non us non 
 # commercial flight aand incident ccident reports
-accidents = xml_df[xml_df["InvestigationType"]=="Accident"] #7420 Accidents
-nuncf = xml_df[xml_df["FARDescription"]=="Non-U.S., Non-Commercial"] #667
+accidents = cohort(cohorts, "accidents") #7420 Accidents
+nuncf = cohort(cohorts, "nuncf") #667
 ## 9% of Accidents are from this group
 
-brazil = nuncf[nuncf["Country"]=="Brazil"] #110 Accidents
+brazil = cohort(cohorts, "brazil") #110 Accidents
 
-brazil_fatal = brazil[brazil["TotalFatalInjuries"]> 0] #101 
+brazil_fatal = cohort(cohorts, "brazil_fatal") #101 
 
 ## 92% of Brazilian Accidents are Fatal
 
@@ -154,74 +146,22 @@ brazil_fatal_list = list(brazil_fatal["EventId"].unique())
 
 #load json file to object
 
-### 145 json files, start at 499, add 500 each time
-
-#create a master dataframe to hold all the .json data from the files in the
-# data folder
-master_json = pd.DataFrame(columns= ["Event_ID", "Narrative", "Cause"])
-
-
-  
-#function to extract json values and create field lists
-def extract_values(obj, key):
-    """Pull all values of specified key from nested JSON."""
-    arr = []
-
-    def extract(obj, arr, key):
-        """Recursively search for values of key in JSON tree."""
-        if isinstance(obj, dict):
-            for k, v in obj.items():
-                if isinstance(v, (dict, list)):
-                    extract(v, arr, key)
-                elif k == key:
-                    arr.append(v)
-        elif isinstance(obj, list):
-            for item in obj:
-                extract(item, arr, key)
-        return arr
-
-    results = extract(obj, arr, key)
-    return results
-
-## iterate through each file, extract the data, and append to master file
-for i in range (1,143):
-    fnum = (i*500)-1
-    with open('./data/NarrativeData_{}.json'.format(fnum)) as f:
-        data = json.load(f)
-  
-    #field lists for each set of json values
-    Event_ID = extract_values(data, 'EventId')
-    narrative = extract_values(data, 'narrative')
-    cause = extract_values(data, 'probable_cause')
-
-    #combine lists into a pandas dataframe
-    json_df = pd.DataFrame(list(zip(Event_ID,narrative,cause)), columns= ["Event_ID", "Narrative", "Cause"])
-    master_json= master_json.append(json_df)
-    print("File {} added".format(fnum))
-
-##add the last file, which doesn't follow the naming convention of others
-with open('./data/NarrativeData_999999.json') as f:
-        data = json.load(f)
-  
-#field lists for each set of json values
-Event_ID = extract_values(data, 'EventId')
-narrative = extract_values(data, 'narrative')
-cause = extract_values(data, 'probable_cause')
-
-#combine lists into a pandas dataframe
-json_df = pd.DataFrame(list(zip(Event_ID,narrative,cause)), columns= ["Event_ID", "Narrative", "Cause"])
-master_json= master_json.append(json_df)
-print("File 999999 added".format(fnum))
-    
-
-#check the length of the master file
-print(len(master_json))
-
-##71,133 files
+### 143 json files, NarrativeData_499.json up to NarrativeData_70999.json
+### (adding 500 each time), plus NarrativeData_999999.json
+
+#the .json data from all the files (71,133 narratives) is loaded into a
+# SQLite narrative store keyed by EventId (./data/cache/narratives.sqlite).
+# It is built on the first run and only files that changed are reloaded
+# after that, see ntsb_narratives.py. Here we only look up the narratives
+# for the brazilian fatal accidents, instead of loading all of them.
+brazil_json = get_narratives(brazil_fatal_list, './data')
+
+#check the number of narratives found
+print(len(brazil_json))
 
 ############ Combine text and xml file data to create corpus
 
-corpus = brazil_fatal.merge(master_json, left_on='EventId', right_on='Event_ID', how='inner')
+corpus = brazil_fatal.merge(brazil_json, left_on='EventId', right_on='Event_ID', how='inner')
 ##93 of 100 matched- not bad!
 
 #preview a corpus record, and test text methods on first narrative
@@ -270,17 +210,125 @@ was being conducted under Brazilian flight regulations.
 ## visualizations of the final report and come back to this, but alas ran
 ## out of time prior to the deadline. 
 
-all_words = list()
+## The tokenizing and stop word removal is now done for a whole list of
+## narratives at once (see ntsb_text.py): the text is lowercased and split
+## into words, and the stop words are removed with a frozen set.
+##
+## The narratives are also identical in format, so before tokenizing, the
+## boilerplate sentences are stripped. These are learned from the full
+## narrative corpus, as the sentences repeated in at least 0.5% of all the
+## narratives ("The foreign authority was the source of this information.",
+## "NTSB investigators may not have traveled in support of...", etc).
+master_json = load_narratives('./data')
+boilerplate = learn_boilerplate(master_json['Narrative'])
+print(boilerplate_examples(master_json['Narrative'], boilerplate))
+
+stop_words = make_stop_words()
+
+all_words = tokenize_narratives(corpus['Narrative'], stop_words, boilerplate)
+print("{} narratives added to list".format(len(all_words)))
+
+## most frequent terms in the brazilian fatal accident narratives
+brazil_counts, brazil_vocab = term_document_matrix(corpus['Narrative'], stop_words, boilerplate)
+print(top_terms(brazil_counts, brazil_vocab, 25))
+
+
+###########################################################
+### Most frequent terms in the full narrative corpus
+###########################################################
+
+## the same counts for all 71,133 narratives, tokenized in chunks across
+## worker processes into a sparse term-document matrix
+counts, vocab = term_document_matrix(master_json['Narrative'], stop_words, boilerplate)
+print(top_terms(counts, vocab, 25))
+
+
+###########################################################
+### Term frequencies over time
+###########################################################
 
-a= set(stopwords.words('english'))
+## Do the word frequencies change over time? The words and two word phrases
+## of every narrative are counted by the year of the event, in an index saved
+## in ./data/cache/term_index. Only new or changed narrative files are
+## counted again when the index is updated (see ntsb_trends.py).
+term_index = update_term_index(xml_df, './data', stop_words=stop_words, boilerplate=boilerplate)
+
+## frequency per 10,000 words, by year
+print(term_trend(term_index, ["mast bumping", "fuel exhaustion", "carburetor ice"], per=10000))
+
+
+###########################################################
+### Mast bumping hypothesis
+###########################################################
+
+## Does the mast bumping found through internet research show up in the
+## narratives? An inverted index of every word of the narratives and
+## probable causes (with its positions, for phrases) is saved in
+## ./data/cache/search_index, so each query takes milliseconds rather
+## than a scan of all the text (see ntsb_search.py).
+search_index = update_search_index('./data')
+
+## the narratives also write it as one hyphenated word
+mast_bumping = '"mast bumping" OR mast-bumping'
+
+brazil_heli_mast = search(search_index, mast_bumping, xml_df=xml_df,
+                          Country="Brazil", AircraftCategory="Helicopter")
+print("{} Brazilian helicopter events mention mast bumping".format(len(brazil_heli_mast)))
+
+## share of helicopter events mentioning it, by country
+print(match_rate(search_index, mast_bumping, xml_df, "Country",
+                 AircraftCategory="Helicopter").head(20))
+
+
+###########################################################
+### TF-IDF of the narratives, compared across groups
+###########################################################
+
+## The narratives are counted and weighted by TF-IDF once, with one row
+## per row of xml_df, and saved in ./data/cache/tfidf (see
+## ntsb_features.py). Any group of xml_df rows is then compared to the
+## full corpus by slicing out its rows, without tokenizing again.
+features = update_feature_store(xml_df, './data', stop_words=stop_words, boilerplate=boilerplate)
+
+nuncf_heli = cohort(cohorts, "nuncf_heli")
+robinson_r44 = xml_df[(xml_df["Make"].str.upper()=="ROBINSON")
+                      & xml_df["Model"].str.upper().str.startswith("R44")]
+
+for name, group in [("nuncf_heli", nuncf_heli), ("brazil_fatal", brazil_fatal),
+                    ("Robinson R44", robinson_r44)]:
+    print(name)
+    print(top_tfidf(features, subset_rows(xml_df, group), 15))
+
+
+###########################################################
+### What is different about each group's narratives?
+###########################################################
+
+## Keyness of every term in a group against the rest of the corpus
+## (log-odds z score and chi-square), from the corpus counts saved with
+## the feature store, so only the group's own rows are added up.
+brazil_heli = cohort(cohorts, "brazil_heli")
+
+for name, group in [("nuncf", nuncf), ("nuncf_heli", nuncf_heli),
+                    ("brazil_heli", brazil_heli), ("brazil_fatal", brazil_fatal)]:
+    print(name)
+    print(keyness(features, subset_rows(xml_df, group), 20))
+
+
+###########################################################
+### Near-duplicate narratives
+###########################################################
 
-for i in range(len(corpus)):   
-    text = corpus['Narrative'][i]
-    #print(text)
-    text1 = word_tokenize(text.lower())
-    #print(text1)
-    stopwords_c = [x for x in text1 if x not in a]
-   # print(stopwords)
-    all_words= all_words.append(stopwords_c)
-    print("Narrative {} added to list".format(i))
-    
+## Several aircraft can share one EventId, and the foreign authority
+## reports reuse text, so some narratives are (nearly) the same. These
+## are grouped with MinHash and LSH (see ntsb_duplicates.py), and the
+## groups saved in ./data/cache/duplicates.parquet.
+dup_groups = update_duplicate_groups('./data', boilerplate=boilerplate)
+print(dup_groups.loc[dup_groups["group_size"] > 1, "group_size"].value_counts())
+
+## the most frequent terms again, counting each group of near-duplicate
+## narratives once
+unique_json = master_json[dup_groups["first_of_group"].to_numpy()]
+print("{} of {} narratives kept".format(len(unique_json), len(master_json)))
+unique_counts, unique_vocab = term_document_matrix(unique_json['Narrative'], stop_words, boilerplate)
+print(top_terms(unique_counts, unique_vocab, 25))
@@ -44,7 +44,10 @@ Created on Wed Feb  5 19:46:24 2020
 ## Import Files
 import json
 import pandas as pd
-import xml.etree.ElementTree as et
+from ntsb_aggregates import aggregate, aggregate_cache, cached, dataset_version
+from ntsb_cohorts import cohort_table
+from ntsb_data import data_version, load_aviation_data
+from ntsb_geo import hotspot_table
 import numpy as np
 import seaborn as sns #visualisation
 import matplotlib
@@ -70,15 +73,18 @@ pd.set_option('display.max_columns',500)
 ## label file path
 path_to_xml_file = "./data/AviationData.xml"
 
-# Load xml file data
-tree = et.parse(path_to_xml_file)
-data = []
-for el in tree.iterfind('./*'):
-    for i in el.iterfind('*'):
-        data.append(dict(i.items()))
+# Load xml file data into a pandas dataframe, streaming the rows
+# (shared loader, see ntsb_data.py). The cleaned dataframe is cached
+# as parquet in ./data/cache, so only the first run parses the XML.
+xml_df = load_aviation_data(path_to_xml_file)
 
-##create pandas dataframe to hold data
-xml_df = pd.DataFrame(data)
+# The groups charted below (accidents, nuncf_heli) are the shared
+# cohorts of ntsb_cohorts.py, and the counts of each chart are cached
+# in ./data/cache/aggregates (see ntsb_aggregates.py). They are only
+# worked out again when the XML or a narrative file changes, so a
+# re-run after changing the charts only redraws them.
+cohorts = cohort_table(xml_df, data_version(path_to_xml_file))
+aggs = aggregate_cache(cohorts, dataset_version(path_to_xml_file, "./data"))
 
 
 ###########################################################
@@ -93,9 +99,9 @@ xml_df = pd.DataFrame(data)
 ## want to confirm by cross referencing with narratives. (if time)
 
 
-# Turn blanks to 0 for fatalities, make int
-xml_df['TotalFatalInjuries'] = xml_df['TotalFatalInjuries'].replace({'':'0'})
-xml_df['TotalFatalInjuries'] = xml_df['TotalFatalInjuries'].astype(int)
+# Blanks are turned to 0 for fatalities, serious injuries, minor
+# injuries and uninjured, and made int, when the data is loaded
+# (clean_aviation_df in ntsb_data.py)
 
 
 ###########################################################
@@ -104,20 +110,16 @@ xml_df['TotalFatalInjuries'] = xml_df['TotalFatalInjuries'].astype(int)
 
 #### Create a chart to demonstrate the large % difference between Non US,
 #### Non commercial fatalities in accidents compared to other groups.
-xml_df["Fatality_bin"] = np.nan
-xml_df['Fatality_bin'].loc[xml_df['InjurySeverity'].str.contains("Fatal\(")==False] = "Non-Fatal"
-xml_df['Fatality_bin'].loc[xml_df['InjurySeverity'].str.contains("Fatal\(")==True] = "Fatal"
-
+#### (Fatality_bin is "Fatal" or "Non-Fatal", parsed from InjurySeverity
+#### when the data is loaded, see add_fatality_cols in ntsb_data.py)
 xml_df["Fatality_bin"].head(15)
-mod_df =xml_df[xml_df["Fatality_bin"].notnull()]
 
-xml_df = xml_df[xml_df["InvestigationType"]=="Accident"] #7420 Accidents
-nuncf = xml_df[xml_df["FARDescription"]=="Non-U.S., Non-Commercial"] #667
+## 7420 Accidents, 667 of them Non-U.S., Non-Commercial
 ## 9% of Accidents are from this group
 
 
-fatal_mod = pd.DataFrame(mod_df[mod_df["Fatality_bin"]=="Fatal"].groupby("FARDescription")['Fatality_bin'].count())
-nonfatal_mod = pd.DataFrame(mod_df[mod_df["Fatality_bin"]=="Non-Fatal"].groupby("FARDescription")['Fatality_bin'].count())
+fatal_mod = aggregate(aggs, [("Fatality_bin", "==", "Fatal")], "FARDescription", {"Fatality_bin": "count"})
+nonfatal_mod = aggregate(aggs, [("Fatality_bin", "==", "Non-Fatal")], "FARDescription", {"Fatality_bin": "count"})
 per_fatal = fatal_mod/(fatal_mod+nonfatal_mod)
 
 print(per_fatal)
@@ -148,10 +150,11 @@ fard.savefig("FARD_chart.png")
 #
 
 
-nuncf_heli = nuncf[nuncf["AircraftCategory"]=="Helicopter"]
-
-fatal_heli = pd.DataFrame(nuncf_heli[nuncf_heli["Fatality_bin"]=="Fatal"].groupby('Country')["Fatality_bin"].count().sort_values(ascending=False))
-nonfatal_heli = pd.DataFrame(nuncf_heli[nuncf_heli["Fatality_bin"]=="Non-Fatal"].groupby('Country')["Fatality_bin"].count().sort_values(ascending=False))
+## Non-U.S., Non-Commercial helicopter accidents (nuncf_heli)
+fatal_heli = aggregate(aggs, {"base": "nuncf_heli", "where": [("Fatality_bin", "==", "Fatal")]},
+                       "Country", {"Fatality_bin": "count"}).sort_values("Fatality_bin", ascending=False)
+nonfatal_heli = aggregate(aggs, {"base": "nuncf_heli", "where": [("Fatality_bin", "==", "Non-Fatal")]},
+                          "Country", {"Fatality_bin": "count"}).sort_values("Fatality_bin", ascending=False)
 perfatal_heli = fatal_heli/(fatal_heli+nonfatal_heli)
 
 perfatal_heli= perfatal_heli.sort_values(by="Fatality_bin", ascending=False).reset_index()
@@ -185,3 +188,42 @@ plot(worldmap)
 #py.iplot(worldmap, filename='Countries with High Percentage of Fatal Accidents')
 
 
+
+
+###########################################################
+### ACCIDENT HOTSPOTS
+###########################################################
+
+#
+# The choropleth above colours a whole country, which hides any hotspots
+# inside it. Here the accidents with coordinates are clustered by density
+# (DBSCAN through a KD-tree, see ntsb_geo.py): a hotspot is a group of
+# places with at least 10 accidents within 25 km, and each is plotted at
+# its centre, sized by its accidents and coloured by its fatality rate.
+#
+
+spots = cached(aggs, "accidents", hotspot_table, km=25, min_points=10)
+print(spots.head(20))
+
+# no hotspot map when no place has enough accidents
+if len(spots):
+    spot_data = dict(type = 'scattergeo',
+                     lat = spots['Latitude'],
+                     lon = spots['Longitude'],
+                     text = spots['Country'].fillna('Unknown').astype(str) + ': ' + spots['accidents'].astype(str) + ' accidents',
+                     marker = dict(size = 4 + 2*np.sqrt(spots['accidents']),
+                                   color = spots['per_fatal'],
+                                   colorscale = 'blues',
+                                   line = dict(color = 'rgb(255,255,255)',width = 0.5),
+                                   colorbar = {'title':'% Fatal','len':0.25,'lenmode':'fraction'}))
+    hotspot_map = gobj.Figure(data = [spot_data],layout = dict(geo = dict(scope='world')))
+
+    hotspot_map.update_layout(
+        title="Accident Hotspots and the <br> Percentage of Fatal Accidents in Each",
+        font=dict(
+            family="Courier New, monospace",
+            size=18,
+            color="#7f7f7f"
+        )
+    )
+    plot(hotspot_map, filename='hotspot_map.html')
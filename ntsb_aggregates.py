@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Cache of aggregated statistics of the NTSB aviation data
+
+@author: allisonyoung
+"""
+############################################################
+#### File Summary ##########################################
+############################################################
+#
+# This module takes as inputs,
+# 1) the cohorts of the cleaned xml_df (see ntsb_cohorts.py)
+# 2) the AviationData.xml file and the narrative .json files, only to
+# tell when the data has changed
+#
+# The same counts (fatal accidents by FARDescription, nuncf helicopters
+# by Country, Brazilian helicopters by Make / Model, ...) were worked
+# out again by every script on every run, even when only the chart code
+# had changed.
+#
+# Processes includes:
+#  A) a version of the data: the cleaned data's version (see
+#     data_version in ntsb_data.py) and the size and modified time of
+#     every narrative file
+#  B) caching each result under a key of (data version, cohort plan,
+#     group keys, aggregation), or (data version, cohort plan, function
+#     and its arguments) for statistics that aren't a plain groupby, plus
+#     a hash of the values of the columns it reads (scripts prepare
+#     xml_df differently) and of the source of the function and the
+#     shared modules it imports
+#  C) the most recently used results in memory (LRU), and every result
+#     as parquet in ./data/cache/aggregates, cleared when the version
+#     changes
+#
+# Usage:
+#  from ntsb_aggregates import aggregate, aggregate_cache, dataset_version
+#  aggs = aggregate_cache(cohorts, dataset_version("./data/AviationData.xml"))
+#  print(aggregate(aggs, "nuncf_heli", "Country",
+#                  {"TotalFatalInjuries": "sum", "EventId": "count"}))
+#  rates = cached(aggs, "known_outcome", fatality_rates, ["EngineType"])
+#
+
+##########################################################
+#### CODE ################################################
+##########################################################
+## Import Files
+import collections
+import glob
+import hashlib
+import inspect
+import json
+import os
+import sys
+import pandas as pd
+
+from ntsb_cohorts import cohort, cohort_plan, column_hash
+from ntsb_data import data_version, path_to_cache_dir, path_to_xml_file
+from ntsb_narratives import narrative_file_keys, path_to_data_dir
+
+## default cache folder, relative to the repository root
+path_to_aggregates = "./data/cache/aggregates"
+
+## results kept in memory, the least recently used go first
+max_memory_results = 128
+
+## bump this whenever a cached statistic changes in a way the source
+## hashes below can't see (e.g. a new pandas default)
+AGGREGATE_VERSION = 1
+
+## source hash of each shared module, worked out once
+_source_hashes = {}
+
+
+##########################################################
+### Data version
+##########################################################
+
+def dataset_version(path=path_to_xml_file, data_dir=path_to_data_dir,
+                    cache_dir=path_to_cache_dir):
+    """Version of the XML data and of the narrative files together."""
+    files = narrative_file_keys(data_dir)
+    sha = hashlib.sha1(json.dumps(files, sort_keys=True).encode("utf-8"))
+    return "{}-{}".format(data_version(path, cache_dir), sha.hexdigest())
+
+
+##########################################################
+### Cache
+##########################################################
+
+def aggregate_cache(cohorts, version, cache_dir=path_to_aggregates,
+                    max_results=max_memory_results):
+    """Cache of the aggregates of some cohorts, for one version of the data."""
+    key_path = os.path.join(cache_dir, "key.json")
+    cached = None
+    if os.path.exists(key_path):
+        with open(key_path) as f:
+            cached = json.load(f)
+    if cached != {"version": version}:
+        os.makedirs(cache_dir, exist_ok=True)
+        for path in glob.glob(os.path.join(cache_dir, "*.parquet")):
+            os.remove(path)
+        with open(key_path, "w") as f:
+            json.dump({"version": version}, f)
+    return {"cohorts": cohorts, "version": version, "cache_dir": cache_dir,
+            "max_results": max_results,
+            "memory": collections.OrderedDict()}
+
+
+def _ntsb_modules(namespace, names=None):
+    """Shared ntsb_ modules a namespace uses (its imports), by name."""
+    found = set()
+    for name, value in namespace.items():
+        if names is not None and name not in names:
+            continue
+        module = (value.__name__ if inspect.ismodule(value)
+                  else getattr(value, "__module__", None))
+        if isinstance(module, str) and module.startswith("ntsb_"):
+            found.add(module)
+    return found
+
+
+def _module_hash(name):
+    """sha1 of a module's source, worked out once."""
+    if name not in _source_hashes:
+        try:
+            source = inspect.getsource(sys.modules[name])
+        except (OSError, TypeError):
+            source = name
+        _source_hashes[name] = hashlib.sha1(source.encode("utf-8")).hexdigest()
+    return _source_hashes[name]
+
+
+def _function_name(func):
+    """Name of a function and a hash of the code it runs, for the cache key."""
+    # The function's own module (or, for a function in a script, its own
+    # source) and every shared module reachable through their imports.
+    # This is the same in every script that makes the same call, and an
+    # edit to a helper the function can reach (e.g. wilson_interval in
+    # ntsb_stats) makes new results.
+    if func.__module__.startswith("ntsb_"):
+        todo, parts = [func.__module__], []
+    else:
+        try:
+            source = inspect.getsource(func)
+        except (OSError, TypeError):
+            source = ""
+        todo = sorted(_ntsb_modules(func.__globals__, func.__code__.co_names))
+        parts = [hashlib.sha1(source.encode("utf-8")).hexdigest()]
+
+    seen = set()
+    while todo:
+        name = todo.pop()
+        if name in seen or name not in sys.modules:
+            continue
+        seen.add(name)
+        todo.extend(_ntsb_modules(vars(sys.modules[name])))
+    parts += ["{}={}".format(i, _module_hash(i)) for i in sorted(seen)]
+    return "{}.{}:{}:{}".format(func.__module__, func.__qualname__,
+                                AGGREGATE_VERSION, ",".join(parts))
+
+
+def _lookup(aggs, key, compute):
+    """Result of a key from memory, then disk, or else compute and save it."""
+    memory = aggs["memory"]
+    if key in memory:
+        memory.move_to_end(key)
+        return memory[key].copy()
+
+    path = os.path.join(aggs["cache_dir"], key + ".parquet")
+    if os.path.exists(path):
+        result = pd.read_parquet(path)
+    else:
+        result = compute()
+        if isinstance(result, pd.Series):
+            result = result.to_frame()
+        result.to_parquet(path)
+
+    memory[key] = result
+    if len(memory) > aggs["max_results"]:
+        memory.popitem(last=False)
+    return result.copy()
+
+
+def _cached(aggs, spec, func, args, kwargs, columns):
+    """func(cohort, *args, **kwargs), keyed on the values of some columns."""
+    # spec None is every row of xml_df. The key includes a hash of the
+    # columns the result is worked out from, as scripts prepare xml_df
+    # differently (5_EDA makes blanks NaN, the others keep '').
+    cohorts = aggs["cohorts"]
+    plan = cohort_plan(spec or [])
+    if columns is None:
+        columns = cohorts["xml_df"].columns
+    columns = list(columns) + [col for col, _, _ in plan]
+    key = [aggs["version"], plan, _function_name(func), args, kwargs,
+           column_hash(cohorts, columns)]
+    key = hashlib.sha1(json.dumps(key, sort_keys=True, default=str)
+                       .encode("utf-8")).hexdigest()
+    return _lookup(aggs, key, lambda: func(cohort(cohorts, plan),
+                                           *args, **kwargs))
+
+
+def cached(aggs, spec, func, *args, **kwargs):
+    """func(cohort, *args, **kwargs) of a cohort, as a dataframe, cached."""
+    # func may read any column, so the key covers all of xml_df's columns
+    return _cached(aggs, spec, func, args, kwargs, None)
+
+
+def _groupby_agg(df, by, agg):
+    """groupby of df on by, aggregated with a pandas agg spec."""
+    return df.groupby(by, observed=True).agg(agg)
+
+
+def aggregate(aggs, spec, by, agg):
+    """groupby(by).agg(agg) of a cohort, as a dataframe, cached."""
+    # agg is anything pandas' agg takes that can be written out as text,
+    # e.g. {"TotalFatalInjuries": "sum"} or {"EventId": "count"}. Only
+    # the group and aggregated columns are in the key, so scripts that
+    # add other columns (Make_canonical, ...) still share the result.
+    by = [by] if isinstance(by, str) else list(by)
+    columns = by + (list(agg) if isinstance(agg, dict) else
+                    list(aggs["cohorts"]["xml_df"].columns))
+    return _cached(aggs, spec, _groupby_agg, (by, agg), {}, columns)
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Bitmap index of the categorical columns of the NTSB aviation data
+
+@author: allisonyoung
+"""
+############################################################
+#### File Summary ##########################################
+############################################################
+#
+# This module takes as inputs,
+# 1) the cleaned xml_df pandas dataframe (see ntsb_data.py), with the
+# text fields stored as categoricals
+#
+# Processes includes:
+#  A) a bitmap index: for each value of the main categorical columns, a
+#     bitset of the rows with that value, packed 8 rows to a byte
+#  B) combining bitsets with & (and), | (or) and ~ (not), which are
+#     plain numpy operations on the packed bytes
+#  C) counting the rows of a bitset, and only taking the rows out of
+#     xml_df at the end, rather than copying a dataframe at every step
+#     of the subsetting
+#
+# Usage:
+#  from ntsb_bitmap import bitmap_index, bitmap, count_rows, select_rows
+#  bits = bitmap_index(xml_df)
+#  brazil_heli = (bitmap(bits, "FARDescription", "Non-U.S., Non-Commercial")
+#                 & bitmap(bits, "AircraftCategory", "Helicopter")
+#                 & bitmap(bits, "Country", "Brazil"))
+#  print(count_rows(bits, brazil_heli))
+#  brazil_heli_df = select_rows(xml_df, bits, brazil_heli)
+#
+
+##########################################################
+#### CODE ################################################
+##########################################################
+## Import Files
+import numpy as np
+import pandas as pd
+
+## columns indexed by default
+bitmap_cols = ["InvestigationType", "FARDescription", "AircraftCategory",
+               "Country", "Make", "Model", "PurposeOfFlight",
+               "BroadPhaseOfFlight", "WeatherCondition", "AircraftDamage",
+               "EngineType", "AmateurBuilt", "NumberOfEngines", "Schedule",
+               "Fatality_bin"]
+
+## columns with up to this many values get every bitset up front, the
+## bitsets of larger columns (Make, Model) are made when first asked for
+max_eager_values = 512
+
+## number of 1 bits in each byte value
+_popcount = np.array([bin(i).count("1") for i in range(256)], dtype=np.int64)
+
+
+##########################################################
+### Build the index
+##########################################################
+
+def bitmap_index(xml_df, cols=bitmap_cols):
+    """Category codes and value bitsets of the categorical columns."""
+    num_rows = len(xml_df)
+    index = {"num_rows": num_rows, "codes": {}, "categories": {},
+             "bitmaps": {}}
+
+    for col in cols:
+        values = xml_df[col].astype("category")
+        codes = values.cat.codes.to_numpy()
+        index["codes"][col] = codes
+        index["categories"][col] = values.cat.categories
+        index["bitmaps"][col] = {}
+
+        num_values = len(values.cat.categories)
+        if num_values <= max_eager_values:
+            # one bitset at a time (missing is -1), so only one row-length
+            # mask is held at once rather than a values x rows matrix
+            for code in range(-1, num_values):
+                _value_bitmap(index, col, code)
+    return index
+
+
+def _value_bitmap(index, col, code):
+    """Bitset of one category code of a column (-1 is missing)."""
+    bitmaps = index["bitmaps"][col]
+    if code not in bitmaps:
+        bitmaps[code] = np.packbits(index["codes"][col] == code)
+    return bitmaps[code]
+
+
+##########################################################
+### Bitsets
+##########################################################
+
+def all_rows(index):
+    """Bitset of every row."""
+    return np.packbits(np.ones(index["num_rows"], dtype=bool))
+
+
+def bitmap(index, col, value):
+    """Bitset of the rows where col equals value (or any of a list)."""
+    # None (or NaN) asks for the rows where the column is missing. A
+    # value that isn't in the column matches no rows.
+    values = [value] if isinstance(value, str) or np.ndim(value) == 0 \
+        else list(value)
+    bits = np.zeros((index["num_rows"] + 7) // 8, dtype=np.uint8)
+    for v in values:
+        if v is None or (isinstance(v, float) and np.isnan(v)):
+            code = -1
+        else:
+            code = index["categories"][col].get_indexer([v])[0]
+            if code < 0:
+                continue
+        bits = bits | _value_bitmap(index, col, code)
+    return bits
+
+
+def _trim(index, bits):
+    """Clear the padding bits past the last row (set by ~)."""
+    extra = len(bits) * 8 - index["num_rows"]
+    if extra:
+        bits = bits.copy()
+        bits[-1] &= np.uint8((0xFF << extra) & 0xFF)
+    return bits
+
+
+def count_rows(index, bits):
+    """Number of rows in a bitset."""
+    return int(_popcount[_trim(index, bits)].sum())
+
+
+def row_numbers(index, bits):
+    """Row numbers (positions in xml_df) of a bitset."""
+    return np.flatnonzero(np.unpackbits(bits, count=index["num_rows"]))
+
+
+def select_rows(xml_df, index, bits, cols=None):
+    """The rows of xml_df in a bitset (and only cols, if given)."""
+    rows = row_numbers(index, bits)
+    if cols is not None:
+        return xml_df.iloc[rows, xml_df.columns.get_indexer(cols)]
+    return xml_df.iloc[rows]
+
+
+def value_counts(index, bits, col):
+    """Count of each value of col within a bitset, without taking rows out."""
+    rows = np.unpackbits(bits, count=index["num_rows"]).astype(bool)
+    codes = index["codes"][col][rows]
+    counts = np.bincount(codes[codes >= 0],
+                         minlength=len(index["categories"][col]))
+    return pd.Series(counts, index=index["categories"][col],
+                     name="count").sort_values(ascending=False)
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Shared cohort definitions for the NTSB aviation data
+
+@author: allisonyoung
+"""
+############################################################
+#### File Summary ##########################################
+############################################################
+#
+# This module takes as inputs,
+# 1) the cleaned xml_df pandas dataframe (see ntsb_data.py), or the
+# parquet cache it is loaded from
+#
+# The case study groups (nuncf, nuncf_heli, brazil_heli, brazil_fatal)
+# were filtered by hand in each script, and drifted apart (one script's
+# nuncf was accidents only, another's was not).
+#
+# Processes includes:
+#  A) one definition of each cohort, as a list of (column, op, value)
+#     filters that all have to hold, optionally on top of another cohort
+#  B) a plan of each cohort: its filters and its base's filters, in a
+#     fixed order, hashed so the same filters reached two ways are the
+#     same cohort
+#  C) evaluating a plan lazily, the first time its rows are asked for.
+#     The categorical filters are ANDs of bitsets of a bitmap index
+#     (see ntsb_bitmap.py), and only the remaining rows are compared for
+#     the other filters
+#  D) memoizing each cohort's row numbers by plan hash and a hash of the
+#     filtered columns' values, in memory and in ./data/cache/cohorts
+#     for the current data version, so the other scripts share them
+#  E) reading a cohort straight from the parquet cache, with its filters
+#     pushed down into the read, when the full xml_df isn't needed
+#
+# Usage:
+#  from ntsb_cohorts import cohort, cohort_table
+#  cohorts = cohort_table(xml_df, data_version("./data/AviationData.xml"))
+#  nuncf_heli = cohort(cohorts, "nuncf_heli")
+#  brazil = cohort(cohorts, [("Country", "==", "Brazil")])
+#
+
+##########################################################
+#### CODE ################################################
+##########################################################
+## Import Files
+import glob
+import hashlib
+import json
+import operator
+import os
+import numpy as np
+import pandas as pd
+
+from ntsb_bitmap import (all_rows, bitmap, bitmap_cols, bitmap_index,
+                         row_numbers)
+from ntsb_data import load_aviation_data, path_to_cache_dir, path_to_xml_file
+
+## default memo folder, relative to the repository root
+path_to_cohort_cache = "./data/cache/cohorts"
+
+## the cohorts of the case study. A cohort is the rows that pass all of
+## its "where" filters, and those of its "base" cohort if it has one.
+cohort_specs = {
+    "accidents": {"where": [("InvestigationType", "==", "Accident")]},
+    # rows with a known outcome, Fatal or Non-Fatal
+    "known_outcome": {"where": [("Fatality_bin", "in",
+                                 ["Fatal", "Non-Fatal"])]},
+    # Non-U.S., Non-Commercial flights, accidents and incidents
+    "nuncf": {"where": [("FARDescription", "==",
+                         "Non-U.S., Non-Commercial")]},
+    "nuncf_accidents": {"base": "nuncf",
+                        "where": [("InvestigationType", "==", "Accident")]},
+    "nuncf_heli": {"base": "nuncf_accidents",
+                   "where": [("AircraftCategory", "==", "Helicopter")]},
+    "brazil": {"base": "nuncf", "where": [("Country", "==", "Brazil")]},
+    "brazil_fatal": {"base": "brazil",
+                     "where": [("TotalFatalInjuries", ">", 0)]},
+    "brazil_heli": {"base": "nuncf_heli",
+                    "where": [("Country", "==", "Brazil")]},
+    "brazil_air": {"base": "brazil",
+                   "where": [("AircraftCategory", "==", "Airplane")]},
+}
+
+## filter operators, the same as pyarrow's parquet filters
+_ops = {"==": operator.eq, "!=": operator.ne, "<": operator.lt,
+        "<=": operator.le, ">": operator.gt, ">=": operator.ge,
+        "in": None, "not in": None}
+
+
+##########################################################
+### Plans
+##########################################################
+
+def _filter_key(value):
+    """Hashable, canonical form of a filter value."""
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (list, tuple, set, np.ndarray, pd.Index)):
+        return tuple(sorted(set(_filter_key(v) for v in value), key=repr))
+    return value
+
+
+def cohort_plan(spec, specs=cohort_specs):
+    """Filters of a cohort (a name, a spec dict or a filter list), in order."""
+    if isinstance(spec, str):
+        spec = specs[spec]
+    if isinstance(spec, dict):
+        filters = list(spec.get("where", []))
+        if spec.get("base") is not None:
+            filters += cohort_plan(spec["base"], specs)
+    else:
+        filters = list(spec)
+
+    plan = set()
+    for col, op, value in filters:
+        if op not in _ops:
+            raise ValueError("unknown filter operator {!r}".format(op))
+        plan.add((col, op, _filter_key(value)))
+    return tuple(sorted(plan, key=repr))
+
+
+def plan_hash(plan):
+    """sha1 of a plan, the key its rows are memoized under."""
+    return hashlib.sha1(json.dumps(plan, default=str).encode("utf-8")
+                        ).hexdigest()
+
+
+##########################################################
+### Evaluate a plan on xml_df
+##########################################################
+
+def cohort_table(xml_df, version=None, cache_dir=path_to_cohort_cache):
+    """Memo of the cohorts of xml_df, saved to cache_dir if version is given."""
+    # version should be data_version() of the file xml_df was loaded
+    # from (xml_df in full), the saved rows are dropped when it changes
+    table = {"xml_df": xml_df, "version": version, "cache_dir": cache_dir,
+             "bits": None, "rows": {}, "column_hashes": {}}
+    if version is not None:
+        key = {"version": version, "num_rows": len(xml_df)}
+        key_path = os.path.join(cache_dir, "key.json")
+        cached = None
+        if os.path.exists(key_path):
+            with open(key_path) as f:
+                cached = json.load(f)
+        if cached != key:
+            os.makedirs(cache_dir, exist_ok=True)
+            for path in glob.glob(os.path.join(cache_dir, "*.npy")):
+                os.remove(path)
+            with open(key_path, "w") as f:
+                json.dump(key, f)
+    return table
+
+
+def column_hash(table, cols):
+    """sha1 of the values of some columns of the table's xml_df."""
+    # Scripts prepare xml_df differently (5_EDA makes blanks NaN, the
+    # others keep ''), so what is memoized from a frame is keyed on the
+    # values of the columns it read, not only on the data version. Each
+    # column is hashed once per table.
+    hashes = table["column_hashes"]
+    sha = hashlib.sha1()
+    for col in sorted(set(cols)):
+        if col not in hashes:
+            values = pd.util.hash_pandas_object(table["xml_df"][col],
+                                                index=False).to_numpy()
+            hashes[col] = hashlib.sha1(values.tobytes()).hexdigest()
+        sha.update((col + "=" + hashes[col] + "\n").encode("utf-8"))
+    return sha.hexdigest()
+
+
+def _bits(table):
+    """Bitmap index of the table, built the first time it is needed."""
+    if table["bits"] is None:
+        xml_df = table["xml_df"]
+        table["bits"] = bitmap_index(
+            xml_df, [i for i in bitmap_cols if i in xml_df.columns])
+    return table["bits"]
+
+
+def _compare(values, op, value):
+    """Mask of the values that pass a filter, missing values never do."""
+    if op in ("in", "not in"):
+        keep = pd.Series(values).isin(value).to_numpy()
+        return keep if op == "in" else ~keep & pd.notna(values)
+    keep = np.asarray(_ops[op](values, value), dtype=bool)
+    return keep & pd.notna(values)
+
+
+def _evaluate(table, plan):
+    """Row numbers of the rows of xml_df that pass every filter of a plan."""
+    # equality filters on the indexed categoricals are bitset ANDs, the
+    # rest are compared on the rows those leave
+    xml_df = table["xml_df"]
+    bits, others = None, []
+    for col, op, value in plan:
+        if op in ("==", "!=", "in", "not in") and col in bitmap_cols \
+                and col in xml_df.columns:
+            index = _bits(table)
+            if bits is None:
+                bits = all_rows(index)
+            values = bitmap(index, col, value)
+            if op in ("!=", "not in"):
+                values = ~(values | bitmap(index, col, None))
+            bits = bits & values
+        else:
+            others.append((col, op, value))
+
+    rows = (np.arange(len(xml_df)) if bits is None
+            else row_numbers(_bits(table), bits))
+    for col, op, value in others:
+        values = xml_df[col].to_numpy()[rows]
+        rows = rows[_compare(values, op, value)]
+    return rows
+
+
+def cohort_rows(table, spec, specs=cohort_specs):
+    """Row numbers (positions in xml_df) of a cohort, memoized."""
+    plan = cohort_plan(spec, specs)
+    key = hashlib.sha1((plan_hash(plan) + column_hash(
+        table, [col for col, _, _ in plan])).encode("utf-8")).hexdigest()
+    if key in table["rows"]:
+        return table["rows"][key]
+
+    path = os.path.join(table["cache_dir"], key + ".npy")
+    if table["version"] is not None and os.path.exists(path):
+        rows = np.load(path)
+    else:
+        rows = _evaluate(table, plan)
+        if table["version"] is not None:
+            np.save(path, rows)
+    table["rows"][key] = rows
+    return rows
+
+
+def cohort(table, spec, specs=cohort_specs):
+    """The rows of xml_df in a cohort, as a dataframe."""
+    # only the row numbers are memoized, each call takes out a new copy
+    return table["xml_df"].iloc[cohort_rows(table, spec, specs)]
+
+
+##########################################################
+### Read a cohort from the parquet cache
+##########################################################
+
+def read_cohort(spec, path=path_to_xml_file, cache_dir=path_to_cache_dir,
+                columns=None, specs=cohort_specs):
+    """Load only a cohort's rows (and columns) from the parquet cache."""
+    filters = [(col, op, list(value) if isinstance(value, tuple) else value)
+               for col, op, value in cohort_plan(spec, specs)]
+    return load_aviation_data(path, cache_dir, columns=columns,
+                              filters=filters or None)
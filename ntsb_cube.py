@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Pre-aggregated counts of the NTSB aviation data
+
+@author: allisonyoung
+"""
+############################################################
+#### File Summary ##########################################
+############################################################
+#
+# This module takes as inputs,
+# 1) the cleaned xml_df pandas dataframe (see ntsb_data.py), with
+# EventDate parsed to datetime64
+#
+# Processes includes:
+#  A) a time cube: the number of events, accidents, fatal events and
+#     fatalities by year x month x FARDescription x AircraftCategory x
+#     Country, built in one groupby
+#  B) yearly or monthly series read from the cube, for any filter on
+#     its fields, rather than grouping xml_df again for each question
+#  C) a drill-down cube: the same counts plus injury totals by
+#     FARDescription x AircraftCategory x Country x Make x Model x
+#     PurposeOfFlight, saved as parquet in ./data/cache/drill_cube.parquet
+#  D) slicing and rolling up the drill-down cube, so a case study
+#     drill-down is a lookup in the cube rather than a full-table scan
+#
+# Usage:
+#  from ntsb_cube import time_cube, time_series, update_drill_cube, rollup
+#  cube = time_cube(xml_df)
+#  print(time_series(cube, "year", AircraftCategory="Helicopter",
+#                    Country="Brazil"))
+#  drill = update_drill_cube(xml_df, data_version(path_to_xml_file))
+#  print(rollup(drill, ["Make", "Model"], Country="Brazil",
+#               AircraftCategory="Helicopter"))
+#
+
+##########################################################
+#### CODE ################################################
+##########################################################
+## Import Files
+import json
+import os
+import numpy as np
+import pandas as pd
+
+## category fields of the time cube
+time_cube_fields = ["FARDescription", "AircraftCategory", "Country"]
+
+## counts held in the cubes
+cube_measures = ["events", "accidents", "fatal", "fatalities"]
+
+## dimensions of the drill-down cube, in the order of the case study
+drill_dims = ["FARDescription", "AircraftCategory", "Country", "Make",
+              "Model", "PurposeOfFlight"]
+
+## the drill-down cube also adds up the other injury counts
+drill_measures = cube_measures + ["serious_injuries", "minor_injuries",
+                                  "uninjured"]
+
+## default drill-down cube file, relative to the repository root
+path_to_drill_cube = "./data/cache/drill_cube.parquet"
+
+
+##########################################################
+### Time cube
+##########################################################
+
+def _measure_cols(xml_df):
+    """The per-row values that the cube adds up."""
+    return pd.DataFrame({
+        "events": np.ones(len(xml_df), dtype=np.int64),
+        "accidents": (xml_df["InvestigationType"] == "Accident").to_numpy(
+            dtype=np.int64),
+        "fatal": (xml_df["Fatality_bin"] == "Fatal").to_numpy(dtype=np.int64),
+        "fatalities": xml_df["TotalFatalInjuries"].to_numpy(dtype=np.int64),
+        "serious_injuries": xml_df["TotalSeriousInjuries"].to_numpy(
+            dtype=np.int64),
+        "minor_injuries": xml_df["TotalMinorInjuries"].to_numpy(
+            dtype=np.int64),
+        "uninjured": xml_df["TotalUninjured"].to_numpy(dtype=np.int64),
+    }, index=xml_df.index)
+
+
+def time_cube(xml_df, fields=time_cube_fields):
+    """Counts by year, month and each combination of the fields."""
+    # rows without an EventDate are left out; a missing field value is
+    # kept as its own group, so the cube still adds up to every dated row
+    dates = xml_df["EventDate"]
+    cube_df = _measure_cols(xml_df)
+    cube_df["year"] = dates.dt.year
+    cube_df["month"] = dates.dt.month
+    for i in fields:
+        cube_df[i] = xml_df[i]
+    cube_df = cube_df[dates.notna().to_numpy()]
+    cube_df = cube_df.astype({"year": int, "month": int})
+
+    cube = cube_df.groupby(["year", "month"] + list(fields), observed=True,
+                           dropna=False)[cube_measures].sum()
+    return cube.reset_index()
+
+
+def _filter_cube(cube, filters):
+    """Rows of a cube with each field equal to (or in a list of) values."""
+    mask = np.ones(len(cube), dtype=bool)
+    for col, value in filters.items():
+        values = [value] if isinstance(value, str) else list(np.atleast_1d(
+            value))
+        mask &= cube[col].isin(values).to_numpy()
+    return cube[mask]
+
+
+def time_series(cube, freq="year", by=None, **filters):
+    """Yearly (or monthly) counts and fatal rate, for a filter on the fields."""
+    # e.g. time_series(cube, "month", AircraftCategory="Helicopter") or
+    # time_series(cube, by="FARDescription"). Years (months) with no
+    # events are filled in with 0 when there is no by. per_fatal is the
+    # share of accidents that were fatal, as in ntsb_stats.
+    keys = ["year"] if freq == "year" else ["year", "month"]
+    by = [] if by is None else ([by] if isinstance(by, str) else list(by))
+    series = _filter_cube(cube, filters).groupby(
+        keys + by, observed=True)[cube_measures].sum()
+
+    # an empty cube has no years to fill in
+    if not by and len(cube):
+        years = range(cube["year"].min(), cube["year"].max() + 1)
+        full = (pd.Index(years, name="year") if freq == "year" else
+                pd.MultiIndex.from_product([years, range(1, 13)],
+                                           names=["year", "month"]))
+        series = series.reindex(full, fill_value=0)
+    series["per_fatal"] = series["fatal"] / series["accidents"].where(
+        series["accidents"] > 0)
+    return series
+
+
+##########################################################
+### Drill-down cube
+##########################################################
+
+def drill_cube(xml_df, dims=drill_dims):
+    """Counts and injury totals for each combination of the dims."""
+    # A missing value is kept as its own group, so rolling the cube up
+    # to any level still gives the totals of the full table.
+    cube_df = _measure_cols(xml_df)
+    for i in dims:
+        cube_df[i] = xml_df[i]
+    cube = cube_df.groupby(list(dims), observed=True,
+                           dropna=False)[drill_measures].sum()
+    return cube.reset_index()
+
+
+def update_drill_cube(xml_df, version, path=path_to_drill_cube,
+                      dims=drill_dims):
+    """Load the saved drill-down cube, rebuilding it if the data changed."""
+    # version is the version of the data, e.g. ntsb_data.data_version()
+    key_path = os.path.splitext(path)[0] + ".key.json"
+    key = {"version": version, "dims": list(dims), "rows": len(xml_df)}
+    if os.path.exists(path) and os.path.exists(key_path):
+        with open(key_path) as f:
+            if json.load(f) == key:
+                return pd.read_parquet(path)
+
+    cube = drill_cube(xml_df, dims)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    # the dims stay categorical, so each value is stored once in parquet
+    cube.to_parquet(path, index=False)
+    with open(key_path, "w") as f:
+        json.dump(key, f)
+    return cube
+
+
+def cube_slice(cube, **filters):
+    """Rows of a cube with each dim equal to (or in a list of) values."""
+    return _filter_cube(cube, filters)
+
+
+def rollup(cube, by=(), **filters):
+    """Add up a slice of the cube to the dims in by, with the fatal rate."""
+    # e.g. rollup(drill, ["Make", "Model"], Country="Brazil",
+    # AircraftCategory="Helicopter"), or rollup(drill) for the totals
+    by = [by] if isinstance(by, str) else list(by)
+    measures = [i for i in drill_measures if i in cube.columns]
+    sliced = _filter_cube(cube, filters)
+    if by:
+        # missing values stay their own group, so the groups add up to the
+        # slice's totals
+        totals = sliced.groupby(by, observed=True,
+                                dropna=False)[measures].sum()
+        totals = totals.sort_values("events", ascending=False)
+    else:
+        totals = sliced[measures].sum().to_frame("total").T
+    totals["per_fatal"] = totals["fatal"] / totals["events"]
+    return totals
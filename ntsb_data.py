@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Shared loading code for the NTSB aviation data
+
+@author: allisonyoung
+"""
+############################################################
+#### File Summary ##########################################
+############################################################
+#
+# This module is imported by the numbered scripts so that
+# every script loads the NTSB export the same way.
+#
+# It takes as inputs,
+# 1) an XML file of data downloaded
+# from the National Transportation Safety Board's database of
+# aviation accidents.
+# (http://www.ntsb.gov/_layouts/ntsb.aviation/index.aspx)
+#
+# Processes includes:
+#  A) streaming the XML file into a pandas dataframe
+#  B) the shared data cleaning of the injury counts, and the
+#     fatal / non-fatal outcome parsed from InjurySeverity
+#  C) parsing EventDate and PublicationDate to datetime64, and
+#     Latitude and Longitude to floats
+#  D) storing the text fields as categoricals
+#  E) a parquet cache of the cleaned dataframe, so later runs skip
+#     the XML parse entirely
+#
+# Usage:
+#  from ntsb_data import load_aviation_data
+#  xml_df = load_aviation_data("./data/AviationData.xml")
+#  brazil = load_aviation_data("./data/AviationData.xml",
+#                              filters=[("Country", "==", "Brazil")])
+#
+
+##########################################################
+#### CODE ################################################
+##########################################################
+## Import Files
+import hashlib
+import json
+import os
+import xml.etree.ElementTree as et
+import numpy as np
+import pandas as pd
+
+## default file paths, relative to the repository root
+path_to_xml_file = "./data/AviationData.xml"
+path_to_cache_dir = "./data/cache"
+
+## bump this whenever the cleaning below changes, so old caches are rebuilt
+CACHE_VERSION = 5
+
+## injury counts that are blank in the export when nobody was hurt
+injury_cols = ["TotalFatalInjuries", "TotalSeriousInjuries",
+               "TotalMinorInjuries", "TotalUninjured"]
+
+## text fields with many repeated values, kept as pandas categoricals (each
+## distinct value is stored once, and rows hold a small integer code).
+## The ids stay as plain strings.
+categorical_cols = ["InvestigationType", "Location", "Country", "AirportCode",
+                    "AirportName", "InjurySeverity", "AircraftDamage",
+                    "AircraftCategory", "Make", "Model", "AmateurBuilt",
+                    "NumberOfEngines", "EngineType", "FARDescription",
+                    "Schedule", "PurposeOfFlight", "AirCarrier",
+                    "WeatherCondition", "BroadPhaseOfFlight", "ReportStatus"]
+
+## dates, entered in the format MM/DD/YYYY
+date_cols = ["EventDate", "PublicationDate"]
+
+## coordinates in decimal degrees, and their valid ranges
+coordinate_cols = {"Latitude": (-90, 90), "Longitude": (-180, 180)}
+
+
+##########################################################
+### Convert XML Data file to pandas DataFrame
+##########################################################
+
+def load_aviation_xml(path=path_to_xml_file):
+    """Stream the rows of the NTSB XML export into a pandas DataFrame."""
+    # The export is <DATA><ROWS><ROW .../>...</ROWS></DATA>, with every
+    # field stored as an attribute of a ROW element. Rather than building
+    # the whole tree, walk it with iterparse and drop each row as soon as
+    # its attributes have been copied into the column lists.
+    columns = {}
+    num_rows = 0
+    depth = 0
+    parent = None
+
+    for event, elem in et.iterparse(path, events=("start", "end")):
+        if event == "start":
+            depth += 1
+            if depth == 2:
+                parent = elem
+            continue
+
+        # only the ROW elements, two levels below the root, hold data
+        row_level = depth == 3
+        depth -= 1
+        if not row_level:
+            continue
+
+        attrs = elem.attrib
+        for key, value in attrs.items():
+            if key not in columns:
+                # first time this field shows up, pad the earlier rows
+                columns[key] = [np.nan] * num_rows
+            columns[key].append(value)
+        num_rows += 1
+        if len(attrs) < len(columns):
+            # fill in the fields this row does not have
+            for values in columns.values():
+                if len(values) < num_rows:
+                    values.append(np.nan)
+
+        # release the row, so memory stays flat while parsing
+        elem.clear()
+        parent.remove(elem)
+
+    return pd.DataFrame(columns)
+
+
+###########################################################
+### Data Cleaning
+###########################################################
+
+## CAUTION!!!!!
+## Assumption made here that a missing value is 0, would
+## want to confirm by cross referencing with narratives. (if time)
+
+def add_fatality_cols(xml_df):
+    """Add Fatality_bin and Fatality_count, parsed from InjurySeverity."""
+    # InjurySeverity is 'Fatal(n)', 'Non-Fatal', 'Incident', 'Unavailable'
+    # or blank. One regex pass pulls out n for the fatal rows, and both
+    # columns are built from that, rather than re-scanning the column
+    # with str.contains for every subset.
+    severity = xml_df["InjurySeverity"]
+    num_fatal = severity.str.extract(r"Fatal\((\d+)\)", expand=False)
+    is_fatal = num_fatal.notna()
+
+    # blank or missing severity is left as NaN, neither fatal nor not
+    unknown = severity.isna() | (severity.str.strip() == "")
+    fatality_bin = np.where(is_fatal, "Fatal", "Non-Fatal").astype(object)
+    fatality_bin[unknown.to_numpy()] = np.nan
+
+    xml_df["Fatality_bin"] = pd.Categorical(fatality_bin,
+                                            categories=["Fatal", "Non-Fatal"])
+    xml_df["Fatality_count"] = num_fatal.fillna(0).astype(int)
+    return xml_df
+
+
+def parse_dates(xml_df, cols=date_cols):
+    """Parse the MM/DD/YYYY date columns to datetime64, blanks to NaT."""
+    # a fixed format is parsed in one vectorized pass, rather than
+    # guessing the format of each value
+    for i in cols:
+        if i in xml_df.columns:
+            xml_df[i] = pd.to_datetime(xml_df[i], format="%m/%d/%Y",
+                                       errors="coerce")
+    return xml_df
+
+
+def parse_coordinates(xml_df, cols=coordinate_cols):
+    """Latitude and Longitude as floats, NaN when blank or out of range."""
+    for i, (low, high) in cols.items():
+        if i in xml_df.columns:
+            values = pd.to_numeric(xml_df[i], errors="coerce")
+            xml_df[i] = values.where(values.between(low, high))
+    return xml_df
+
+
+def encode_categoricals(xml_df, cols=categorical_cols):
+    """Store the repetitive text columns as pandas categoricals."""
+    for i in cols:
+        if i in xml_df.columns:
+            xml_df[i] = xml_df[i].astype("category")
+    return xml_df
+
+
+def clean_aviation_df(xml_df):
+    """Blank injury counts to 0 (as ints), add fatality columns, parse fields."""
+    for i in injury_cols:
+        xml_df[i] = xml_df[i].replace({'': '0'}).astype(int)
+    xml_df = add_fatality_cols(xml_df)
+    xml_df = parse_dates(xml_df)
+    xml_df = parse_coordinates(xml_df)
+    return encode_categoricals(xml_df)
+
+
+###########################################################
+### Columnar cache of the cleaned DataFrame
+###########################################################
+
+def file_hash(path, chunk_size=1 << 20):
+    """Return the sha1 hex digest of a file, read in chunks."""
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _cache_paths(path, cache_dir):
+    """Parquet file and its key file for a given XML file."""
+    name = os.path.splitext(os.path.basename(path))[0]
+    return (os.path.join(cache_dir, name + ".parquet"),
+            os.path.join(cache_dir, name + ".key.json"))
+
+
+def data_version(path=path_to_xml_file, cache_dir=path_to_cache_dir):
+    """Version of the cleaned data: the cache version and the XML's sha1."""
+    # read from the cache key written by load_aviation_data, so the XML
+    # is only hashed again if there is no key yet
+    _, key_path = _cache_paths(path, cache_dir)
+    key = {}
+    if os.path.exists(key_path):
+        with open(key_path) as f:
+            key = json.load(f)
+    if key.get("version") != CACHE_VERSION or "sha1" not in key:
+        key = {"version": CACHE_VERSION, "sha1": file_hash(path)}
+    return "{}-{}".format(key["version"], key["sha1"])
+
+
+def load_aviation_data(path=path_to_xml_file, cache_dir=path_to_cache_dir,
+                       refresh=False, columns=None, filters=None):
+    """Load the cleaned xml_df, from the parquet cache when it is current."""
+    # columns and filters (pyarrow's (column, op, value) form) are pushed
+    # down into the parquet read, so only those columns, and the rows
+    # that pass every filter, are converted to pandas
+    parquet_path, key_path = _cache_paths(path, cache_dir)
+    st = os.stat(path)
+    key = {"version": CACHE_VERSION, "size": st.st_size,
+           "mtime": st.st_mtime_ns}
+
+    if not refresh and os.path.exists(parquet_path) and os.path.exists(key_path):
+        with open(key_path) as f:
+            cached = json.load(f)
+        # size and mtime are a cheap check, the hash is only read when
+        # the file was touched (e.g. copied) but may not have changed
+        same = (cached.get("version") == key["version"]
+                and cached.get("size") == key["size"])
+        if same and cached.get("mtime") != key["mtime"]:
+            key["sha1"] = file_hash(path)
+            same = cached.get("sha1") == key["sha1"]
+            if same:
+                with open(key_path, 'w') as f:
+                    json.dump(key, f)
+        if same:
+            return pd.read_parquet(parquet_path, columns=columns,
+                                   filters=filters)
+
+    xml_df = clean_aviation_df(load_aviation_xml(path))
+
+    os.makedirs(cache_dir, exist_ok=True)
+    xml_df.to_parquet(parquet_path, index=False)
+    key["sha1"] = file_hash(path)
+    with open(key_path, 'w') as f:
+        json.dump(key, f)
+    if columns is not None or filters is not None:
+        return pd.read_parquet(parquet_path, columns=columns, filters=filters)
+    return xml_df
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Near-duplicate NTSB narratives, found with MinHash and LSH
+
+@author: allisonyoung
+"""
+############################################################
+#### File Summary ##########################################
+############################################################
+#
+# This module takes as inputs,
+# 1) Data in .json format from the incident narratives
+#
+# Processes includes:
+#  A) a MinHash signature of each narrative's five word phrases
+#     (shingles), computed in chunks across worker processes
+#  B) locality-sensitive hashing (LSH) of the signatures in bands, so
+#     only narratives that share a band are compared, instead of every
+#     pair of the 71k narratives
+#  C) a duplicate group id for each narrative, saved with its Event_ID
+#     in ./data/cache/duplicates.parquet, to count each group once
+#
+# Usage:
+#  from ntsb_duplicates import update_duplicate_groups
+#  groups = update_duplicate_groups("./data")
+#  master_json = master_json[~master_json["Event_ID"].isin(
+#      groups.loc[~groups["first_of_group"], "Event_ID"])]
+#
+
+##########################################################
+#### CODE ################################################
+##########################################################
+## Import Files
+import json
+import os
+import zlib
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+
+from ntsb_narratives import (load_narratives, narrative_file_keys,
+                             path_to_data_dir)
+from ntsb_text import map_chunks, strip_boilerplate, token_pattern
+
+## default output file, relative to the repository root
+path_to_duplicates = "./data/cache/duplicates.parquet"
+
+## words per shingle, and MinHash signature length (bands x rows per band)
+shingle_size = 5
+lsh_bands = 16
+lsh_rows = 4
+
+## narratives whose estimated Jaccard similarity is at least this are
+## counted as near-duplicates
+min_similarity = 0.8
+
+## narratives per block when computing the signatures, to bound memory
+_block_size = 200
+_mix = np.uint64(0x9E3779B97F4A7C15)
+
+
+##########################################################
+### MinHash signatures
+##########################################################
+
+def _hash_functions(num_hashes, seed=0):
+    """Random odd multipliers and offsets of the hash functions."""
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, 2 ** 63, num_hashes, dtype=np.uint64) | np.uint64(1)
+    b = rng.integers(0, 2 ** 63, num_hashes, dtype=np.uint64)
+    return a, b
+
+
+def _shingle_hashes(text, boilerplate, size):
+    """64 bit hash of each run of size words in a narrative."""
+    if not isinstance(text, str):
+        return np.zeros(0, dtype=np.uint64)
+    words = token_pattern.findall(strip_boilerplate(text, boilerplate).lower())
+    if not words:
+        # a narrative that is only boilerplate is compared as it stands
+        words = token_pattern.findall(text.lower())
+    words = np.array([zlib.crc32(w.encode("utf-8")) for w in words],
+                     dtype=np.uint64)
+    if len(words) == 0:
+        return words
+    size = min(size, len(words))
+
+    # combine the word hashes of each window, wrapping around 2**64
+    hashes = words[:len(words) - size + 1].copy()
+    for i in range(1, size):
+        hashes = hashes * _mix ^ words[i:len(words) - size + 1 + i]
+    return np.unique(hashes)
+
+
+def _minhash_chunk(args):
+    """MinHash signatures of one chunk of narratives (worker process)."""
+    # Each of the hash functions (a * x + b) >> 32 gives every shingle a
+    # pseudo-random rank; the signature keeps each function's minimum. A
+    # narrative with no words gets no signature (has_words False).
+    texts, boilerplate, size, a, b = args
+    signatures = np.full((len(texts), len(a)), np.iinfo(np.uint32).max,
+                         dtype=np.uint32)
+    has_words = np.zeros(len(texts), dtype=bool)
+
+    for start in range(0, len(texts), _block_size):
+        shingles = [_shingle_hashes(t, boilerplate, size)
+                    for t in texts[start:start + _block_size]]
+        lengths = np.array([len(s) for s in shingles])
+        docs = start + np.flatnonzero(lengths)
+        if len(docs) == 0:
+            continue
+        x = np.concatenate(shingles)
+        ranks = ((x[:, None] * a + b) >> np.uint64(32)).astype(np.uint32)
+        bounds = np.cumsum(lengths[lengths > 0]) - lengths[lengths > 0]
+        signatures[docs] = np.minimum.reduceat(ranks, bounds, axis=0)
+        has_words[docs] = True
+    return signatures, has_words
+
+
+def minhash_signatures(texts, boilerplate=None, size=shingle_size,
+                       num_hashes=lsh_bands * lsh_rows, processes=None):
+    """MinHash signature of every text, and which texts had any words."""
+    a, b = _hash_functions(num_hashes)
+    signatures, has_words = [], []
+    for chunk_sigs, chunk_has in map_chunks(_minhash_chunk, texts, processes,
+                                            boilerplate, size, a, b):
+        signatures.append(chunk_sigs)
+        has_words.append(chunk_has)
+    if not signatures:
+        return np.zeros((0, num_hashes), dtype=np.uint32), np.zeros(0, bool)
+    return np.vstack(signatures), np.concatenate(has_words)
+
+
+##########################################################
+### LSH and duplicate groups
+##########################################################
+
+def near_duplicate_groups(signatures, has_words, bands=lsh_bands,
+                          rows=lsh_rows, threshold=min_similarity):
+    """Group number of each text, texts in a group are near-duplicates."""
+    # Texts whose signatures agree on all rows of any band land in the
+    # same bucket. Within a bucket (sorted by band key), only adjacent
+    # members are candidate pairs, kept if their signatures agree on at
+    # least threshold of the hashes, an estimate of the Jaccard
+    # similarity of their shingles. The groups are the connected pieces
+    # of the pairs.
+    # This is a deliberate approximation, to keep the pairs linear in
+    # the bucket size rather than every pair of a big bucket. A chain of
+    # adjacent pairs (and the other bands) usually joins the whole
+    # bucket, but a member that fails the threshold against both of its
+    # neighbours can split a group that a full comparison would keep.
+    num_texts = len(signatures)
+    texts = np.flatnonzero(has_words)
+    pairs = []
+    for band in range(bands):
+        block = signatures[texts, band * rows:(band + 1) * rows]
+        key = np.zeros(len(texts), dtype=np.uint64)
+        for col in block.T:
+            key = key * _mix ^ col.astype(np.uint64)
+        order = np.argsort(key, kind="stable")
+        same = key[order][1:] == key[order][:-1]
+        pairs.append(np.column_stack([texts[order][:-1][same],
+                                      texts[order][1:][same]]))
+
+    pairs = np.unique(np.vstack(pairs), axis=0)
+    similarity = (signatures[pairs[:, 0]] == signatures[pairs[:, 1]]).mean(
+        axis=1) if len(pairs) else np.zeros(0)
+    pairs = pairs[similarity >= threshold]
+
+    graph = sparse.csr_matrix(
+        (np.ones(len(pairs), dtype=bool), (pairs[:, 0], pairs[:, 1])),
+        shape=(num_texts, num_texts))
+    _, groups = connected_components(graph, directed=False)
+    return groups
+
+
+def _groups_key(data_dir, boilerplate):
+    """Narrative files and settings the duplicate groups depend on."""
+    return {"files": narrative_file_keys(data_dir),
+            "settings": [shingle_size, lsh_bands, lsh_rows, min_similarity],
+            "boilerplate": sorted(str(k) for k in (boilerplate or {}))}
+
+
+def update_duplicate_groups(data_dir=path_to_data_dir,
+                            path=path_to_duplicates, boilerplate=None,
+                            processes=None):
+    """Duplicate group of every narrative, recomputed if the files changed."""
+    key_path = os.path.splitext(path)[0] + ".key.json"
+    key = _groups_key(data_dir, boilerplate)
+    if os.path.exists(path) and os.path.exists(key_path):
+        with open(key_path) as f:
+            if json.load(f) == key:
+                return pd.read_parquet(path)
+
+    master_json = load_narratives(data_dir, processes)
+    signatures, has_words = minhash_signatures(master_json["Narrative"],
+                                               boilerplate,
+                                               processes=processes)
+    groups = near_duplicate_groups(signatures, has_words)
+
+    # number the groups by their first narrative, and flag that one as
+    # the narrative to keep when deduplicating
+    group_ids = pd.Series(groups).groupby(groups).transform("idxmin")
+    dup_df = pd.DataFrame({"Event_ID": master_json["Event_ID"],
+                           "dup_group": group_ids.to_numpy(),
+                           "group_size": np.bincount(groups)[groups]})
+    dup_df["first_of_group"] = dup_df["dup_group"] == np.arange(len(dup_df))
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    dup_df.to_parquet(path, index=False)
+    with open(key_path, "w") as f:
+        json.dump(key, f)
+    return dup_df
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+TF-IDF feature store for the NTSB narratives
+
+@author: allisonyoung
+"""
+############################################################
+#### File Summary ##########################################
+############################################################
+#
+# This module takes as inputs,
+# 1) the xml_df pandas dataframe (see ntsb_data.py)
+# 2) Data in .json format from the incident narratives
+#
+# Processes includes:
+#  A) counting the words of each event's narrative, and weighting the
+#     counts by TF-IDF, with one row per row of xml_df (the row of an
+#     event without a narrative is empty)
+#  B) saving both matrices in compressed sparse row (CSR) form as .npy
+#     arrays in ./data/cache/tfidf, which are memory-mapped when loaded
+#  C) comparing any subset of xml_df (nuncf_heli, brazil_fatal, the
+#     Robinson R44s, ...) to the full corpus by slicing its rows,
+#     rather than tokenizing the text again
+#  D) ranking the terms that set a subset's narratives apart from the
+#     rest of the corpus (log-odds and chi-square keyness), against
+#     the corpus counts saved with the store
+#
+# Usage:
+#  from ntsb_features import update_feature_store, subset_rows, top_tfidf
+#  features = update_feature_store(xml_df, "./data")
+#  rows = subset_rows(xml_df, brazil_fatal)
+#  print(top_tfidf(features, rows, 25))
+#  print(keyness(features, rows, 25))
+#
+
+##########################################################
+#### CODE ################################################
+##########################################################
+## Import Files
+import hashlib
+import json
+import os
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from ntsb_narratives import (load_narratives, narrative_file_keys,
+                             path_to_data_dir)
+from ntsb_text import english_stopwords, term_document_matrix
+
+## default store folder, relative to the repository root
+path_to_feature_store = "./data/cache/tfidf"
+
+## bump this whenever the weighting or the layout below changes
+STORE_VERSION = 2
+
+## arrays of the store, the two matrices share indptr and indices
+_store_arrays = ["indptr", "indices", "counts", "tfidf", "idf",
+                 "term_totals", "corpus_mean", "event_rows"]
+
+
+##########################################################
+### Build the store
+##########################################################
+
+def _store_key(xml_df, data_dir, stop_words, boilerplate, ngrams):
+    """Everything the store depends on, to tell when it must be rebuilt."""
+    sha = hashlib.sha1()
+    for event_id in xml_df["EventId"].astype(str):
+        sha.update(event_id.encode("utf-8") + b"\n")
+    return {"version": STORE_VERSION,
+            "event_ids": sha.hexdigest(),
+            "files": narrative_file_keys(data_dir),
+            "ngrams": ngrams,
+            "stop_words": sorted(stop_words),
+            "boilerplate": sorted(str(k) for k in (boilerplate or {}))}
+
+
+def tfidf_weights(counts):
+    """TF-IDF of a narratives x terms count matrix, rows scaled to length 1."""
+    # smoothed idf, log((1 + n) / (1 + df)) + 1, so a word in every
+    # narrative still keeps a small weight
+    num_docs = counts.shape[0]
+    doc_freq = counts.getnnz(axis=0)
+    idf = np.log((1 + num_docs) / (1 + doc_freq)) + 1
+
+    tfidf = sparse.csr_matrix(counts, dtype=np.float32, copy=True)
+    tfidf.data *= idf[tfidf.indices].astype(np.float32)
+    norms = np.sqrt(np.asarray(tfidf.multiply(tfidf).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    tfidf.data /= np.repeat(norms, np.diff(tfidf.indptr)).astype(np.float32)
+    return tfidf, idf
+
+
+def build_feature_store(xml_df, data_dir=path_to_data_dir,
+                        store_dir=path_to_feature_store, stop_words=None,
+                        boilerplate=None, ngrams=1, processes=None):
+    """Count and weight the narratives, one row per xml_df row, and save."""
+    stop_words = english_stopwords() if stop_words is None else stop_words
+    master_json = load_narratives(data_dir, processes)
+    counts, vocab = term_document_matrix(master_json["Narrative"], stop_words,
+                                         boilerplate, processes, ngrams)
+
+    # add up the narratives of an event, in case it has more than one
+    codes, events = pd.factorize(master_json["Event_ID"])
+    keep = codes >= 0
+    by_event = sparse.csr_matrix(
+        (np.ones(keep.sum(), dtype=np.int32),
+         (codes[keep], np.flatnonzero(keep))),
+        shape=(len(events), counts.shape[0]))
+    counts = (by_event @ counts).tocsr()
+    counts.sum_duplicates()
+    counts.sort_indices()
+
+    # the idf is taken over the events, before the events with several
+    # aircraft (several xml_df rows) are repeated below
+    tfidf, idf = tfidf_weights(counts)
+    term_totals = np.asarray(counts.sum(axis=0)).ravel()
+
+    # line the rows up with xml_df, a row with no narrative points at an
+    # extra empty row at the end
+    rows = pd.Index(events).get_indexer(xml_df["EventId"])
+    event_rows = rows.copy()
+    rows[rows < 0] = counts.shape[0]
+    empty = sparse.csr_matrix((1, counts.shape[1]))
+    counts = sparse.vstack([counts, empty.astype(np.int32)], format="csr")[rows]
+    tfidf = sparse.vstack([tfidf, empty.astype(np.float32)], format="csr")[rows]
+
+    # indptr and indices keep the index type scipy picked for the matrix,
+    # so loading doesn't have to convert (copy) them
+    arrays = {"indptr": counts.indptr,
+              "indices": counts.indices,
+              "counts": counts.data.astype(np.int32),
+              "tfidf": tfidf.data.astype(np.float32),
+              "idf": idf,
+              "term_totals": term_totals,
+              "corpus_mean": np.asarray(tfidf.mean(axis=0)).ravel(),
+              # narrative (event) number of each row, -1 if none
+              "event_rows": event_rows}
+    os.makedirs(store_dir, exist_ok=True)
+    for name, values in arrays.items():
+        np.save(os.path.join(store_dir, name + ".npy"), values)
+    with open(os.path.join(store_dir, "vocab.txt"), "w",
+              encoding="utf-8") as f:
+        f.writelines(w + "\n" for w in vocab)
+
+    key = _store_key(xml_df, data_dir, stop_words, boilerplate, ngrams)
+    with open(os.path.join(store_dir, "key.json"), "w") as f:
+        json.dump(key, f)
+    return store_dir
+
+
+def update_feature_store(xml_df, data_dir=path_to_data_dir,
+                         store_dir=path_to_feature_store, stop_words=None,
+                         boilerplate=None, ngrams=1, processes=None):
+    """Rebuild the store if xml_df, the narratives or settings changed; load it."""
+    stop_words = english_stopwords() if stop_words is None else stop_words
+    key_path = os.path.join(store_dir, "key.json")
+    cached = None
+    if os.path.exists(key_path):
+        with open(key_path) as f:
+            cached = json.load(f)
+    if cached != _store_key(xml_df, data_dir, stop_words, boilerplate, ngrams):
+        build_feature_store(xml_df, data_dir, store_dir, stop_words,
+                            boilerplate, ngrams, processes)
+    return load_feature_store(store_dir)
+
+
+##########################################################
+### Load the store
+##########################################################
+
+def load_feature_store(store_dir=path_to_feature_store):
+    """Counts and TF-IDF matrices, on arrays memory-mapped from disk."""
+    arrays = {name: np.load(os.path.join(store_dir, name + ".npy"),
+                            mmap_mode="r") for name in _store_arrays}
+    with open(os.path.join(store_dir, "vocab.txt"), encoding="utf-8") as f:
+        vocab = np.array(f.read().split("\n")[:-1], dtype=object)
+
+    # the matrices are built around the mapped arrays without copying
+    # them, only the rows that are sliced out are read into memory
+    shape = (len(arrays["indptr"]) - 1, len(vocab))
+    matrices = {name: sparse.csr_matrix(
+        (arrays[name], arrays["indices"], arrays["indptr"]), shape=shape,
+        copy=False) for name in ["counts", "tfidf"]}
+
+    return {"counts": matrices["counts"],
+            "tfidf": matrices["tfidf"],
+            "vocab": vocab,
+            "idf": arrays["idf"],
+            "term_totals": arrays["term_totals"],
+            "corpus_mean": arrays["corpus_mean"],
+            "event_rows": arrays["event_rows"]}
+
+
+##########################################################
+### Compare subsets to the corpus
+##########################################################
+
+def subset_rows(xml_df, subset):
+    """Row numbers of the store for a subset of xml_df (or a boolean mask)."""
+    # the subset is matched on the index, so it has to be taken from
+    # xml_df as it is (not re-indexed, or read again from the cache)
+    if isinstance(subset, pd.DataFrame):
+        rows = xml_df.index.get_indexer(subset.index)
+        if (rows < 0).any():
+            raise ValueError("{} rows of the subset aren't rows of xml_df"
+                             .format((rows < 0).sum()))
+        return rows
+    return np.flatnonzero(np.asarray(subset, dtype=bool))
+
+
+def top_tfidf(features, rows, n=25):
+    """The n terms with the highest mean TF-IDF in some rows, vs the corpus."""
+    if len(rows) == 0:
+        return pd.DataFrame({"mean_tfidf": [], "corpus_mean_tfidf": [],
+                             "ratio": []}, index=pd.Index([], name="term"))
+    mean = np.asarray(features["tfidf"][rows].mean(axis=0)).ravel()
+    top = np.argsort(-mean, kind="stable")[:n]
+    corpus_mean = np.asarray(features["corpus_mean"])[top]
+    return pd.DataFrame({"mean_tfidf": mean[top],
+                         "corpus_mean_tfidf": corpus_mean,
+                         "ratio": mean[top] / corpus_mean},
+                        index=pd.Index(features["vocab"][top], name="term"))
+
+
+def _event_counts(features, rows):
+    """Summed word counts of some rows, counting each narrative once."""
+    # the aircraft of one event share a narrative, keep one row per event
+    rows = np.asarray(rows)
+    events = np.asarray(features["event_rows"])[rows]
+    _, first = np.unique(events, return_index=True)
+    rows = rows[first[events[first] >= 0]]
+    return np.asarray(features["counts"][rows].sum(axis=0)).ravel()
+
+
+def keyness(features, rows, n=25, min_count=3, background_rows=None):
+    """Terms most over-used in some rows' narratives, vs the rest."""
+    # Each term's count in the subset is set against its count in the
+    # rest of the corpus (the saved corpus totals minus the subset), so
+    # only the subset's rows are summed. Two scores are given:
+    #  log_odds_z - log-odds ratio of the term in the subset vs the rest,
+    #      with an informative Dirichlet prior from the corpus counts,
+    #      over its standard error (Monroe et al., "Fightin' Words")
+    #  chi2 - Pearson chi-square of the 2x2 table of (term, other terms)
+    #      x (subset, rest)
+    # Terms are ranked by log_odds_z, and need min_count uses in the subset.
+    sub = _event_counts(features, rows).astype(float)
+    totals = np.asarray(features["term_totals"], dtype=float)
+    if background_rows is None:
+        rest = totals - sub
+    else:
+        rest = _event_counts(features, background_rows).astype(float)
+    sub_total, rest_total = sub.sum(), rest.sum()
+
+    prior = totals * (sub_total / totals.sum())
+    prior_total = prior.sum()
+    with np.errstate(divide="ignore", invalid="ignore"):
+        log_odds = (np.log((sub + prior)
+                           / (sub_total + prior_total - sub - prior))
+                    - np.log((rest + prior)
+                             / (rest_total + prior_total - rest - prior)))
+        log_odds_z = log_odds / np.sqrt(1 / (sub + prior) + 1 / (rest + prior))
+
+        n_all = sub_total + rest_total
+        chi2 = (n_all * (sub * (rest_total - rest)
+                         - rest * (sub_total - sub)) ** 2
+                / ((sub + rest) * (n_all - sub - rest)
+                   * sub_total * rest_total))
+
+    candidates = np.flatnonzero(sub >= min_count)
+    top = candidates[np.argsort(-log_odds_z[candidates], kind="stable")[:n]]
+    return pd.DataFrame({"count": sub[top].astype(int),
+                         "per_10k": sub[top] / sub_total * 10000,
+                         "rest_per_10k": rest[top] / rest_total * 10000,
+                         "log_odds_z": log_odds_z[top],
+                         "chi2": chi2[top]},
+                        index=pd.Index(features["vocab"][top], name="term"))
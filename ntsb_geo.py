@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Spatial index of the NTSB accident locations
+
+@author: allisonyoung
+"""
+############################################################
+#### File Summary ##########################################
+############################################################
+#
+# This module takes as inputs,
+# 1) the cleaned xml_df pandas dataframe (see ntsb_data.py), with
+# Latitude and Longitude parsed to floats
+#
+# Processes includes:
+#  A) a spatial index of the rows with coordinates: a KD-tree of the
+#     points on the unit sphere, and the rows sorted by latitude
+#  B) the accidents within N km of a point (great-circle distance)
+#  C) the accidents inside a latitude / longitude bounding box
+#  D) accident hotspots: DBSCAN-style density clusters of the points,
+#     found through the KD-tree, with the fatality rate of each
+#
+# Both queries return row numbers of xml_df, so the matching rows (and
+# their EventIds, to join to the narratives) are xml_df.iloc[rows].
+#
+# Usage:
+#  from ntsb_geo import geo_index, within_radius, within_box
+#  index = geo_index(xml_df)
+#  rows = within_radius(index, 61.2181, -149.9003, 50)  # Anchorage
+#  near_anchorage = xml_df.iloc[rows]
+#  labels = hotspots(index, km=25, min_points=10)
+#  print(hotspot_rates(xml_df, index, labels).head(20))
+#
+
+##########################################################
+#### CODE ################################################
+##########################################################
+## Import Files
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+
+from ntsb_stats import wilson_interval
+
+## mean radius of the earth
+earth_radius_km = 6371.0088
+
+
+##########################################################
+### Build the index
+##########################################################
+
+def unit_vectors(lat, lon):
+    """Points on the unit sphere (x, y, z) for latitudes and longitudes."""
+    lat, lon = np.radians(lat), np.radians(lon)
+    return np.column_stack([np.cos(lat) * np.cos(lon),
+                            np.cos(lat) * np.sin(lon),
+                            np.sin(lat)])
+
+
+def geo_index(xml_df):
+    """KD-tree and latitude order of the xml_df rows with coordinates."""
+    lat = xml_df["Latitude"].to_numpy(dtype=float)
+    lon = xml_df["Longitude"].to_numpy(dtype=float)
+    rows = np.flatnonzero(~np.isnan(lat) & ~np.isnan(lon))
+    lat, lon = lat[rows], lon[rows]
+
+    # the tree holds 3d points so that distances don't bend near the
+    # poles or break across the date line, as they would in lat/long
+    order = np.argsort(lat, kind="stable")
+    return {"rows": rows,
+            "lat": lat,
+            "lon": lon,
+            "tree": cKDTree(unit_vectors(lat, lon)),
+            "lat_order": order,
+            "sorted_lat": lat[order]}
+
+
+##########################################################
+### Queries
+##########################################################
+
+def chord_length(km):
+    """Straight-line distance on the unit sphere for a great-circle km."""
+    # a great-circle distance d is a chord of 2 sin(d / 2R)
+    return 2 * np.sin(min(km / earth_radius_km, np.pi) / 2)
+
+
+def within_radius(index, lat, lon, km):
+    """xml_df row numbers of the accidents within km of a point."""
+    chord = chord_length(km)
+    hits = index["tree"].query_ball_point(unit_vectors(lat, lon)[0],
+                                          chord + 1e-12)
+    return np.sort(index["rows"][hits])
+
+
+def within_box(index, south, west, north, east):
+    """xml_df row numbers of the accidents inside a bounding box."""
+    # the latitude band is found by binary search of the sorted
+    # latitudes, then only those points are checked for longitude. A box
+    # with west > east crosses the date line.
+    lo = np.searchsorted(index["sorted_lat"], south, side="left")
+    hi = np.searchsorted(index["sorted_lat"], north, side="right")
+    band = index["lat_order"][lo:hi]
+    lon = index["lon"][band]
+    if west <= east:
+        inside = (lon >= west) & (lon <= east)
+    else:
+        inside = (lon >= west) | (lon <= east)
+    return np.sort(index["rows"][band[inside]])
+
+
+##########################################################
+### Hotspots
+##########################################################
+
+def hotspots(index, km=25, min_points=10):
+    """Hotspot (cluster) number of each indexed point, -1 if in none."""
+    # DBSCAN: a core point has at least min_points accidents (itself
+    # included) within km. Core points within km of each other are in
+    # the same hotspot, and any other point within km of a core point
+    # joins the hotspot of its nearest core point. The neighbours are
+    # all found through the KD-tree, never a full distance matrix.
+    tree = index["tree"]
+    chord = chord_length(km)
+    num_points = tree.n
+    counts = tree.query_ball_point(tree.data, chord, return_length=True)
+    core = np.flatnonzero(counts >= min_points)
+    labels = np.full(num_points, -1, dtype=np.int64)
+    if len(core) == 0:
+        return labels
+
+    core_tree = cKDTree(tree.data[core])
+    pairs = core_tree.query_pairs(chord, output_type="ndarray")
+    graph = sparse.csr_matrix(
+        (np.ones(len(pairs), dtype=bool), (pairs[:, 0], pairs[:, 1])),
+        shape=(len(core), len(core)))
+    _, core_labels = connected_components(graph, directed=False)
+    labels[core] = core_labels
+
+    border = np.flatnonzero(labels < 0)
+    dist, nearest = core_tree.query(tree.data[border],
+                                    distance_upper_bound=chord)
+    near = np.isfinite(dist)
+    labels[border[near]] = core_labels[nearest[near]]
+    return labels
+
+
+def _most_common(values):
+    """Most common value, NaN if every value is missing."""
+    mode = pd.Series(values).mode()
+    return mode.iloc[0] if len(mode) else np.nan
+
+
+def hotspot_rates(xml_df, index, labels, z=1.96):
+    """Accidents, fatal accidents and fatality rate (95% CI) per hotspot."""
+    in_spot = labels >= 0
+    rows = index["rows"][in_spot]
+    spot_df = pd.DataFrame({
+        "hotspot": labels[in_spot],
+        "fatal": (xml_df["Fatality_bin"].to_numpy()[rows] == "Fatal"),
+        "known": xml_df["Fatality_bin"].notna().to_numpy()[rows],
+        "Country": xml_df["Country"].to_numpy()[rows],
+    })
+    # the centre is the mean of the points on the sphere, moved back to
+    # the surface, so hotspots across the date line average correctly
+    xyz = index["tree"].data[in_spot]
+    for i, axis in enumerate("xyz"):
+        spot_df[axis] = xyz[:, i]
+
+    rates = spot_df.groupby("hotspot").agg(
+        accidents=("fatal", "size"), known=("known", "sum"),
+        fatal=("fatal", "sum"), x=("x", "mean"), y=("y", "mean"),
+        z=("z", "mean"),
+        Country=("Country", _most_common))
+    rates["per_fatal"] = rates["fatal"] / rates["known"]
+    rates["ci_low"], rates["ci_high"] = wilson_interval(rates["fatal"],
+                                                        rates["known"], z)
+    rates["Latitude"] = np.degrees(np.arctan2(
+        rates["z"], np.hypot(rates["x"], rates["y"])))
+    rates["Longitude"] = np.degrees(np.arctan2(rates["y"], rates["x"]))
+    return (rates.drop(columns=["x", "y", "z"])
+            .sort_values("accidents", ascending=False))
+
+
+def hotspot_table(xml_df, km=25, min_points=10, z=1.96):
+    """Hotspots of xml_df and their fatality rates, in one call."""
+    index = geo_index(xml_df)
+    return hotspot_rates(xml_df, index, hotspots(index, km, min_points), z)
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Canonical aircraft Make and Model names for the NTSB aviation data
+
+@author: allisonyoung
+"""
+############################################################
+#### File Summary ##########################################
+############################################################
+#
+# This module takes as inputs,
+# 1) the cleaned xml_df pandas dataframe (see ntsb_data.py), with Make
+# and Model stored as categoricals
+#
+# The export spells the same aircraft several ways ("CESSNA" and
+# "Cessna", "PA-34" and "PA34", "R44" and "R44 - II"), which splits the
+# counts of any groupby on Make or Model.
+#
+# Processes includes:
+#  A) normalizing each distinct Make and Model (case, punctuation,
+#     company words such as AIRCRAFT CO, variant suffixes such as - II)
+#  B) clustering misspelled Makes, comparing only the names that share
+#     their first letters (blocking) with a string similarity score
+#  C) a lookup table of (Make, Model) -> canonical Make and Model, saved
+#     in ./data/cache/make_model.parquet, and only rebuilt when a new
+#     Make / Model pair shows up
+#  D) adding Make_canonical and Model_canonical columns to xml_df, as a
+#     remap of the categorical codes
+#
+# Usage:
+#  from ntsb_makes import add_canonical_make_model
+#  xml_df = add_canonical_make_model(xml_df)
+#  xml_df.groupby(["Make_canonical", "Model_canonical"], observed=True)
+#
+
+##########################################################
+#### CODE ################################################
+##########################################################
+## Import Files
+import difflib
+import os
+import re
+import numpy as np
+import pandas as pd
+
+## default lookup table, relative to the repository root
+path_to_make_model = "./data/cache/make_model.parquet"
+
+## company words dropped from a Make, e.g. "CESSNA AIRCRAFT CO" -> CESSNA
+company_words = {"AIRCRAFT", "AIRCRAFTS", "AIRPLANE", "AIRPLANES", "CO",
+                 "COMPANY", "CORP", "CORPORATION", "INC", "INCORPORATED",
+                 "LTD", "LIMITED", "LLC", "MFG", "MANUFACTURING", "INDUSTRIES",
+                 "INTERNATIONAL", "INTL", "AVIATION", "HELICOPTER",
+                 "HELICOPTERS", "THE"}
+
+## Makes at least this similar (difflib ratio) are the same Make, and
+## only names with at least min_make_length characters are compared
+make_similarity = 0.9
+min_make_length = 5
+
+## letters a Make has to share at the start to be compared (the block),
+## along with all of its digits
+block_chars = 2
+
+_non_alnum = re.compile(r"[^A-Z0-9]+")
+## a variant after " - " ("R44 - II", "R22 - BETA"), or a trailing roman
+## numeral ("R44 II"), is part of the same model family
+_model_variant = re.compile(r"\s+-\s+.*$|\s+(?:I{1,3}|IV|V|VI{1,3})$")
+
+
+##########################################################
+### Normalize
+##########################################################
+
+def make_key(make):
+    """Make in capitals, without punctuation or company words."""
+    words = _non_alnum.sub(" ", str(make).upper()).split()
+    kept = [w for w in words if w not in company_words]
+    return " ".join(kept or words)
+
+
+def model_key(model):
+    """Model in capitals, without punctuation or a variant suffix."""
+    model = _model_variant.sub("", str(model).strip().upper())
+    return _non_alnum.sub("", model)
+
+
+def _most_common(df, keys, col):
+    """Most common (by rows) value of col for each group of keys."""
+    top = df.sort_values("rows", ascending=False, kind="stable")
+    return top.drop_duplicates(keys).set_index(keys)[col]
+
+
+##########################################################
+### Cluster the Makes
+##########################################################
+
+def _find(parent, i):
+    """Root of i in a union-find forest, halving the path as it goes."""
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+
+def cluster_makes(keys):
+    """Cluster number of each normalized Make, misspellings together."""
+    # Only keys in the same block (same first letters, and the same
+    # digits, so "MAKER 1" and "MAKER 2" stay apart) are compared, and
+    # difflib's cheap upper bounds are checked before the full ratio, so
+    # the thousands of Makes take a few seconds rather than every pair.
+    keys = list(keys)
+    parent = list(range(len(keys)))
+    blocks = {}
+    for i, key in enumerate(keys):
+        if len(key) >= min_make_length:
+            block = (key[:block_chars], re.sub(r"\D", "", key))
+            blocks.setdefault(block, []).append(i)
+
+    for members in blocks.values():
+        for n, i in enumerate(members):
+            matcher = difflib.SequenceMatcher(None, keys[i])
+            for j in members[n + 1:]:
+                matcher.set_seq1(keys[j])
+                if (matcher.real_quick_ratio() >= make_similarity
+                        and matcher.quick_ratio() >= make_similarity
+                        and matcher.ratio() >= make_similarity):
+                    parent[_find(parent, j)] = _find(parent, i)
+    return np.array([_find(parent, i) for i in range(len(keys))])
+
+
+##########################################################
+### Lookup table
+##########################################################
+
+def build_make_model_table(xml_df):
+    """Canonical Make and Model for each distinct (Make, Model) pair."""
+    pairs = (xml_df.groupby(["Make", "Model"], observed=True, dropna=False)
+             .size().rename("rows").reset_index())
+    pairs = pairs[pairs["rows"] > 0].reset_index(drop=True)
+
+    # Makes: normalize, cluster the normalized names, then name each
+    # cluster by its most common spelling in the data
+    makes = pairs.groupby("Make", observed=True, dropna=False)["rows"].sum()
+    keys = pd.Series([make_key(m) for m in makes.index], index=makes.index)
+    unique_keys = pd.Index(keys.unique())
+    clusters = cluster_makes(unique_keys)[unique_keys.get_indexer(keys)]
+    make_df = pd.DataFrame({"Make": makes.index, "rows": makes.to_numpy(),
+                            "cluster": clusters})
+    names = _most_common(make_df, ["cluster"], "Make")
+    make_df["Make_canonical"] = names[make_df["cluster"]].to_numpy()
+    pairs = pairs.merge(make_df[["Make", "Make_canonical"]], on="Make",
+                        how="left")
+
+    # Models: the same model key within a canonical Make is one model,
+    # named by its most common spelling. Model codes aren't fuzzy matched,
+    # as one character can be a different aircraft (172 and 177).
+    pairs["key"] = [model_key(m) for m in pairs["Model"]]
+    names = _most_common(pairs, ["Make_canonical", "key"], "Model")
+    pairs = pairs.merge(names.rename("Model_canonical").reset_index(),
+                        on=["Make_canonical", "key"], how="left")
+
+    # a missing Make or Model stays missing
+    pairs.loc[pairs["Make"].isna(), "Make_canonical"] = np.nan
+    pairs.loc[pairs["Model"].isna(), "Model_canonical"] = np.nan
+    return pairs[["Make", "Model", "Make_canonical", "Model_canonical",
+                  "rows"]].astype({"Make": object, "Model": object})
+
+
+def update_make_model_table(xml_df, path=path_to_make_model):
+    """Load the lookup table, rebuilding it if xml_df's pairs changed."""
+    # rebuilt when a pair is new or has gone, as the canonical names are
+    # the most common spellings of the pairs in the table
+    if os.path.exists(path):
+        table = pd.read_parquet(path)
+        known = pd.MultiIndex.from_frame(table[["Make", "Model"]].fillna(""))
+        current = pd.MultiIndex.from_frame(
+            xml_df[["Make", "Model"]].astype(object).fillna("")).unique()
+        if current.isin(known).all() and known.isin(current).all():
+            return table
+
+    table = build_make_model_table(xml_df)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    table.to_parquet(path, index=False)
+    return table
+
+
+##########################################################
+### Apply the table
+##########################################################
+
+def _table_codes(values, categories):
+    """Codes of table values in a column's categories, shifted so NaN is 0."""
+    codes = categories.get_indexer(pd.Index(values, dtype=object)) + 1
+    # a value that isn't one of the categories can't match any row
+    codes[(codes == 0) & pd.notna(values)] = -1
+    return codes
+
+
+def add_canonical_make_model(xml_df, table=None, path=path_to_make_model):
+    """Add Make_canonical and Model_canonical columns to xml_df."""
+    # Each row's (Make, Model) category codes are looked up in the table
+    # as one integer per pair, so no strings are compared per row.
+    if table is None:
+        table = update_make_model_table(xml_df, path)
+    make = xml_df["Make"].astype("category")
+    model = xml_df["Model"].astype("category")
+    num_models = len(model.cat.categories) + 1
+
+    row_pairs = ((make.cat.codes.to_numpy(dtype=np.int64) + 1) * num_models
+                 + model.cat.codes.to_numpy(dtype=np.int64) + 1)
+    make_codes = _table_codes(table["Make"], make.cat.categories)
+    model_codes = _table_codes(table["Model"], model.cat.categories)
+    # table pairs with a Make or Model that isn't in xml_df match no rows,
+    # and are dropped so the pair codes left are unique
+    known = (make_codes >= 0) & (model_codes >= 0)
+    table = table[known]
+    table_pairs = make_codes[known] * num_models + model_codes[known]
+    pos = pd.Index(table_pairs).get_indexer(row_pairs)
+    if (pos < 0).any():
+        raise ValueError("{} rows have a Make / Model pair that isn't in "
+                         "the lookup table".format((pos < 0).sum()))
+
+    for i in ["Make_canonical", "Model_canonical"]:
+        xml_df[i] = pd.Categorical(table[i].to_numpy(dtype=object)[pos])
+    return xml_df
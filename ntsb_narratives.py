@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Shared loading code for the NTSB narrative text
+
+@author: allisonyoung
+"""
+############################################################
+#### File Summary ##########################################
+############################################################
+#
+# This module takes as inputs,
+# 1) Data in .json format from the incident narratives,
+# the NarrativeData_*.json files in the data folder. Each file
+# holds {"data": [{"EventId", "narrative", "probable_cause"}, ...]}
+#
+# Processes includes:
+#  A) finding the narrative files in the data folder
+#  B) reading them in parallel, one file per worker process
+#  C) building a single dataframe of all the narratives
+#  D) a SQLite store of the narratives keyed by EventId, so the
+#     narratives for a few events can be looked up without loading
+#     all of them
+#
+# Usage:
+#  from ntsb_narratives import load_narratives, get_narratives
+#  master_json = load_narratives("./data")
+#  corpus_text = get_narratives(brazil_fatal["EventId"])
+#
+
+##########################################################
+#### CODE ################################################
+##########################################################
+## Import Files
+import glob
+import json
+import multiprocessing as mp
+import os
+import re
+import sqlite3
+import warnings
+import pandas as pd
+
+## default data folder and narrative store, relative to the repository root
+path_to_data_dir = "./data"
+path_to_narrative_db = "./data/cache/narratives.sqlite"
+
+## columns of the narrative dataframe
+narrative_cols = ["Event_ID", "Narrative", "Cause"]
+
+
+##########################################################
+### Find the narrative files
+##########################################################
+
+def file_number(path):
+    """Pull the number out of a NarrativeData_{number}.json file name."""
+    return int(re.search(r"NarrativeData_(\d+)\.json$", path).group(1))
+
+
+def find_narrative_files(data_dir=path_to_data_dir):
+    """List the NarrativeData_*.json files, in file number order."""
+    # 499, 999, ... 70999 and then 999999, which doesn't follow the
+    # naming convention of the others but sorts last by number
+    paths = glob.glob(os.path.join(data_dir, "NarrativeData_*.json"))
+    return sorted(paths, key=file_number)
+
+
+def narrative_file_keys(data_dir=path_to_data_dir):
+    """Size and modification time of each narrative file, by file number."""
+    # the caches built from the narratives compare these to tell which
+    # files are new, changed or gone
+    keys = {}
+    for path in find_narrative_files(data_dir):
+        st = os.stat(path)
+        keys[str(file_number(path))] = [st.st_size, st.st_mtime_ns]
+    return keys
+
+
+##########################################################
+### Read the narrative files
+##########################################################
+
+def extract_records(data):
+    """Yield (EventId, narrative, probable_cause) for each json record."""
+    # Each record is read once, and a missing field comes back as None,
+    # so a record without a probable_cause can't shift the later rows
+    # (as zipping separately extracted lists of each key would).
+    for record in data["data"]:
+        yield (record.get("EventId"), record.get("narrative"),
+               record.get("probable_cause"))
+
+
+def read_narrative_file(path):
+    """Read one narrative file into Event_ID, Narrative, Cause lists."""
+    with open(path) as f:
+        data = json.load(f)
+
+    Event_ID, narrative, cause = [], [], []
+    for event_id, text, probable_cause in extract_records(data):
+        Event_ID.append(event_id)
+        narrative.append(text)
+        cause.append(probable_cause)
+    return file_number(path), Event_ID, narrative, cause
+
+
+def _pool_context():
+    """Multiprocessing context to read the files with, or None."""
+    # The scripts are plain top-to-bottom files with no __main__ guard,
+    # so the "spawn" and "forkserver" start methods would re-run the whole
+    # calling script in every worker. Only fork is safe here; without it
+    # the files are read one after another.
+    if "fork" in mp.get_all_start_methods():
+        return mp.get_context("fork")
+    return None
+
+
+def read_narrative_files(paths, processes):
+    """Yield read_narrative_file results for each path, in order."""
+    ctx = _pool_context()
+    processes = processes or os.cpu_count() or 1
+
+    if ctx is None or processes == 1:
+        yield from map(read_narrative_file, paths)
+        return
+
+    with ctx.Pool(processes) as pool:
+        # imap keeps the file order while the workers read ahead
+        yield from pool.imap(read_narrative_file, paths)
+
+
+##########################################################
+### Build the full narrative dataframe
+##########################################################
+
+def load_narratives(data_dir=path_to_data_dir, processes=None):
+    """Load every narrative file into one dataframe, indexed 0..n-1."""
+    # extend one list per column and build the dataframe once at the end,
+    # rather than appending dataframes (which copies the frame each time)
+    paths = find_narrative_files(data_dir)
+    Event_ID, narrative, cause = [], [], []
+    for fnum, ids, texts, causes in read_narrative_files(paths, processes):
+        Event_ID.extend(ids)
+        narrative.extend(texts)
+        cause.extend(causes)
+
+    master_json = pd.DataFrame({"Event_ID": Event_ID,
+                                "Narrative": narrative,
+                                "Cause": cause}, columns=narrative_cols)
+
+    # an event should only be in one file, drop any repeated records, and
+    # flag events that show up more than once with different text
+    repeats = master_json.duplicated()
+    if repeats.any():
+        master_json = master_json[~repeats].reset_index(drop=True)
+        print("Dropped {} repeated narrative records".format(repeats.sum()))
+    conflicts = master_json["Event_ID"].duplicated(keep=False)
+    if conflicts.any():
+        warnings.warn("{} narrative records share an Event_ID with different "
+                      "text".format(conflicts.sum()))
+    return master_json
+
+
+##########################################################
+### Narrative store, keyed by EventId
+##########################################################
+
+def _connect_store(db_path):
+    """Open the narrative store, creating the tables if needed."""
+    os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+    con = sqlite3.connect(db_path)
+    con.execute("CREATE TABLE IF NOT EXISTS files ("
+                "file_number INTEGER PRIMARY KEY, size INTEGER, mtime INTEGER)")
+    # EventId is the primary key, so lookups go through its index
+    con.execute("CREATE TABLE IF NOT EXISTS narratives ("
+                "Event_ID TEXT PRIMARY KEY, Narrative TEXT, Cause TEXT, "
+                "file_number INTEGER)")
+    return con
+
+
+def update_narrative_store(data_dir=path_to_data_dir,
+                           db_path=path_to_narrative_db, processes=None):
+    """Load new or changed narrative files into the store."""
+    con = _connect_store(db_path)
+    stored = {fnum: (size, mtime) for fnum, size, mtime
+              in con.execute("SELECT file_number, size, mtime FROM files")}
+
+    # compare each file's size and modification time to what was stored
+    paths = {file_number(p): p for p in find_narrative_files(data_dir)}
+    current = {int(fnum): (paths[int(fnum)], size, mtime) for fnum,
+               (size, mtime) in narrative_file_keys(data_dir).items()
+               if int(fnum) in paths}
+    changed = [path for fnum, (path, size, mtime) in current.items()
+               if stored.get(fnum) != (size, mtime)]
+    removed = [fnum for fnum in stored if fnum not in current]
+
+    with con:
+        for fnum in removed:
+            con.execute("DELETE FROM narratives WHERE file_number = ?", (fnum,))
+            con.execute("DELETE FROM files WHERE file_number = ?", (fnum,))
+        for fnum, ids, texts, causes in read_narrative_files(changed,
+                                                              processes):
+            con.execute("DELETE FROM narratives WHERE file_number = ?", (fnum,))
+            con.executemany("INSERT OR REPLACE INTO narratives "
+                            "VALUES (?, ?, ?, ?)",
+                            zip(ids, texts, causes, [fnum] * len(ids)))
+            _, size, mtime = current[fnum]
+            con.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?)",
+                        (fnum, size, mtime))
+    con.close()
+    return db_path
+
+
+def get_narratives(event_ids, data_dir=path_to_data_dir,
+                   db_path=path_to_narrative_db):
+    """Look up the narratives for a list of EventIds in the store."""
+    update_narrative_store(data_dir, db_path)
+    event_ids = list(dict.fromkeys(event_ids))
+
+    con = sqlite3.connect(db_path)
+    rows = []
+    # sqlite limits the number of ? parameters, so query in batches
+    for start in range(0, len(event_ids), 500):
+        batch = event_ids[start:start + 500]
+        marks = ",".join("?" * len(batch))
+        rows.extend(con.execute("SELECT Event_ID, Narrative, Cause "
+                                "FROM narratives WHERE Event_ID IN "
+                                "({})".format(marks), batch))
+    con.close()
+
+    # return the rows in the order the EventIds were asked for
+    order = {event_id: i for i, event_id in enumerate(event_ids)}
+    rows.sort(key=lambda row: order[row[0]])
+    return pd.DataFrame(rows, columns=narrative_cols)
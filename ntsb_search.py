@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Keyword search over the NTSB narratives and probable causes
+
+@author: allisonyoung
+"""
+############################################################
+#### File Summary ##########################################
+############################################################
+#
+# This module takes as inputs,
+# 1) Data in .json format from the incident narratives
+# 2) the xml_df pandas dataframe (see ntsb_data.py), to filter the
+# matching events by Country, AircraftCategory, Make, etc.
+#
+# Processes includes:
+#  A) building an inverted index of the narrative and probable_cause
+#     text: for each word, the narratives it is in and the positions
+#     of the word in each, saved as numpy arrays in
+#     ./data/cache/search_index
+#  B) phrase ("mast bumping") and boolean (AND, OR, NOT, parentheses,
+#     prefix*) queries against the index
+#  C) filtering the matching EventIds by xml_df columns, and the share
+#     of events in each group whose narrative matches a query
+#
+# Usage:
+#  from ntsb_search import update_search_index, search, match_rate
+#  index = update_search_index("./data")
+#  ids = search(index, '"mast bumping" OR "mast bump*"', xml_df=xml_df,
+#               Country="Brazil", AircraftCategory="Helicopter")
+#  print(match_rate(index, '"mast bumping"', xml_df, "AircraftCategory"))
+#
+
+##########################################################
+#### CODE ################################################
+##########################################################
+## Import Files
+import json
+import os
+import re
+import numpy as np
+
+from ntsb_narratives import (load_narratives, narrative_file_keys,
+                             path_to_data_dir)
+from ntsb_text import map_chunks, token_pattern
+
+## default index folder, relative to the repository root
+path_to_search_index = "./data/cache/search_index"
+
+## text fields that are indexed, by the name used in queries
+search_fields = {"narrative": "Narrative", "cause": "Cause"}
+
+## bump this whenever the index layout or tokenizing below changes
+INDEX_VERSION = 1
+
+## query pieces: quoted phrases, parentheses, and everything else
+_query_token = re.compile(r'"[^"]*"|\(|\)|[^\s()"]+')
+
+
+##########################################################
+### Build the index
+##########################################################
+
+def _position_chunk(args):
+    """Term number and position of every word in one chunk of texts."""
+    # Run in a worker process. Unlike ntsb_text.tokenize, no stop words
+    # are removed, so the positions line up with the original text and a
+    # phrase such as "loss of engine power" can be matched word for word.
+    texts, = args
+    vocab = {}
+    terms, docs, positions = [], [], []
+    for doc, text in enumerate(texts):
+        if not isinstance(text, str):
+            continue
+        words = token_pattern.findall(text.lower())
+        terms.extend(vocab.setdefault(w, len(vocab)) for w in words)
+        docs.extend([doc] * len(words))
+        positions.extend(range(len(words)))
+    return (len(texts), list(vocab), np.array(terms, dtype=np.int32),
+            np.array(docs, dtype=np.int32), np.array(positions, dtype=np.int32))
+
+
+def _collect_positions(texts, vocab, processes):
+    """(term, doc, position) arrays for all texts, on the shared vocab."""
+    terms, docs, positions = [], [], []
+    offset = 0
+    for num_texts, chunk_vocab, chunk_terms, chunk_docs, chunk_positions in \
+            map_chunks(_position_chunk, texts, processes):
+        ids = np.array([vocab.setdefault(w, len(vocab)) for w in chunk_vocab],
+                       dtype=np.int32)
+        terms.append(ids[chunk_terms])
+        docs.append(chunk_docs + offset)
+        positions.append(chunk_positions)
+        offset += num_texts
+    empty = [np.zeros(0, dtype=np.int32)]
+    return (np.concatenate(terms or empty), np.concatenate(docs or empty),
+            np.concatenate(positions or empty))
+
+
+def _write_field(index_dir, field, terms, docs, positions, num_terms):
+    """Save the posting lists of one field as numpy arrays."""
+    # Sort by term, keeping the (doc, position) order within each term.
+    # The postings of term t are docs[term_ptr[t]:term_ptr[t + 1]], and
+    # the positions of posting p are positions[pos_ptr[p]:pos_ptr[p + 1]].
+    order = np.argsort(terms, kind="stable")
+    terms, docs, positions = terms[order], docs[order], positions[order]
+    new_posting = np.ones(len(terms), dtype=bool)
+    new_posting[1:] = (terms[1:] != terms[:-1]) | (docs[1:] != docs[:-1])
+    starts = np.flatnonzero(new_posting)
+
+    arrays = {
+        "term_ptr": np.searchsorted(terms[starts], np.arange(num_terms + 1)),
+        "docs": docs[starts],
+        "pos_ptr": np.append(starts, len(terms)),
+        "positions": positions,
+    }
+    for name, values in arrays.items():
+        np.save(os.path.join(index_dir, "{}_{}.npy".format(field, name)),
+                values)
+
+
+def build_search_index(data_dir=path_to_data_dir,
+                       index_dir=path_to_search_index, processes=None):
+    """Build the inverted index of the narrative and cause text."""
+    master_json = load_narratives(data_dir, processes)
+    os.makedirs(index_dir, exist_ok=True)
+
+    vocab = {}
+    collected = {}
+    for field, col in search_fields.items():
+        collected[field] = _collect_positions(master_json[col], vocab,
+                                              processes)
+
+    # number the terms alphabetically, so a term is found by binary
+    # search and a prefix (bump*) is a range of term numbers
+    words = np.array(list(vocab), dtype=object)
+    order = np.argsort(words)
+    rank = np.empty(len(words), dtype=np.int32)
+    rank[order] = np.arange(len(words), dtype=np.int32)
+
+    for field, (terms, docs, positions) in collected.items():
+        _write_field(index_dir, field, rank[terms], docs, positions,
+                     len(words))
+    collected = None
+
+    with open(os.path.join(index_dir, "terms.txt"), "w",
+              encoding="utf-8") as f:
+        f.writelines(w + "\n" for w in words[order])
+    np.save(os.path.join(index_dir, "event_ids.npy"),
+            master_json["Event_ID"].fillna("").to_numpy(dtype=str))
+
+    meta = {"version": INDEX_VERSION, "files": narrative_file_keys(data_dir)}
+    with open(os.path.join(index_dir, "meta.json"), "w") as f:
+        json.dump(meta, f)
+    return index_dir
+
+
+def update_search_index(data_dir=path_to_data_dir,
+                        index_dir=path_to_search_index, processes=None):
+    """Rebuild the index if the narrative files changed, and load it."""
+    # The narratives are numbered across all the files, so a changed file
+    # means rebuilding the whole index (rather than one file, as in
+    # ntsb_trends.py). The files rarely change, and a build is quick.
+    meta_path = os.path.join(index_dir, "meta.json")
+    meta = None
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+    if (meta is None or meta["version"] != INDEX_VERSION
+            or meta["files"] != narrative_file_keys(data_dir)):
+        build_search_index(data_dir, index_dir, processes)
+    return load_search_index(index_dir)
+
+
+##########################################################
+### Load the index
+##########################################################
+
+def load_search_index(index_dir=path_to_search_index):
+    """Open the index, with the posting arrays memory-mapped from disk."""
+    with open(os.path.join(index_dir, "terms.txt"), encoding="utf-8") as f:
+        terms = np.array(f.read().split("\n")[:-1], dtype=object)
+
+    fields = {}
+    for field in search_fields:
+        fields[field] = {
+            name: np.load(os.path.join(index_dir, "{}_{}.npy".format(field,
+                                                                     name)),
+                          mmap_mode="r")
+            for name in ["term_ptr", "docs", "pos_ptr", "positions"]}
+
+    event_ids = np.load(os.path.join(index_dir, "event_ids.npy"),
+                        mmap_mode="r")
+    return {"terms": terms, "fields": fields, "event_ids": event_ids}
+
+
+##########################################################
+### Parse queries
+##########################################################
+
+def parse_query(query):
+    """Parse a query into a tree of ('and'|'or'|'not'|'phrase'|'prefix', ...)."""
+    # Words next to each other are ANDed, "quotes" make a phrase, a
+    # trailing * matches any word starting with the prefix, and
+    # AND / OR / NOT / parentheses combine them, e.g.
+    #   "mast bumping" OR (rotor AND mast) NOT "tail rotor"
+    pieces = _query_token.findall(query)
+    tree, end = _parse_or(pieces, 0)
+    if end != len(pieces):
+        raise ValueError("could not parse query at '{}'".format(pieces[end]))
+    return tree
+
+
+def _parse_or(pieces, i):
+    """a OR b OR ..., from pieces[i] on."""
+    left, i = _parse_and(pieces, i)
+    while i < len(pieces) and pieces[i] == "OR":
+        right, i = _parse_and(pieces, i + 1)
+        left = ("or", left, right)
+    return left, i
+
+
+def _parse_and(pieces, i):
+    """a AND b, or a b, from pieces[i] on."""
+    left, i = _parse_not(pieces, i)
+    while i < len(pieces) and pieces[i] not in ("OR", ")"):
+        if pieces[i] == "AND":
+            i += 1
+        right, i = _parse_not(pieces, i)
+        left = ("and", left, right)
+    return left, i
+
+
+def _parse_not(pieces, i):
+    """NOT a, from pieces[i] on."""
+    if i < len(pieces) and pieces[i] == "NOT":
+        inner, i = _parse_not(pieces, i + 1)
+        return ("not", inner), i
+    return _parse_term(pieces, i)
+
+
+def _parse_term(pieces, i):
+    """a word, prefix*, "phrase" or (group), from pieces[i] on."""
+    if i >= len(pieces):
+        raise ValueError("query ends where a word was expected")
+    piece = pieces[i]
+    if piece == "(":
+        inner, i = _parse_or(pieces, i + 1)
+        if i >= len(pieces) or pieces[i] != ")":
+            raise ValueError("missing ')' in query")
+        return inner, i + 1
+    if piece == ")":
+        raise ValueError("unexpected ')' in query")
+
+    if not piece.startswith('"') and piece.endswith("*"):
+        return ("prefix", piece[:-1].lower()), i + 1
+    # a quoted phrase, or a word such as "pr-ito." that is tokenized the
+    # same way as the narratives
+    words = token_pattern.findall(piece.strip('"').lower())
+    if not words:
+        raise ValueError("no words to search for in '{}'".format(piece))
+    return ("phrase", tuple(words)), i + 1
+
+
+##########################################################
+### Run queries
+##########################################################
+
+_no_docs = np.zeros(0, dtype=np.int32)
+
+
+def _term_number(index, word):
+    """Number of a word in the index, or None if it never appears."""
+    i = np.searchsorted(index["terms"], word)
+    if i < len(index["terms"]) and index["terms"][i] == word:
+        return i
+    return None
+
+
+def _postings(postings, t):
+    """Docs containing term t, and the doc and position of each occurrence."""
+    lo, hi = postings["term_ptr"][t], postings["term_ptr"][t + 1]
+    docs = np.asarray(postings["docs"][lo:hi])
+    pos_ptr = np.asarray(postings["pos_ptr"][lo:hi + 1])
+    positions = np.asarray(postings["positions"][pos_ptr[0]:pos_ptr[-1]])
+    return docs, np.repeat(docs, np.diff(pos_ptr)), positions
+
+
+def _phrase_docs(index, postings, words):
+    """Docs with the words in this order, next to each other."""
+    numbers = [_term_number(index, w) for w in words]
+    if any(t is None for t in numbers):
+        return _no_docs
+    if len(numbers) == 1:
+        return np.asarray(_postings(postings, numbers[0])[0])
+
+    # Only docs with every word can match, so narrow to those first. Then
+    # each occurrence of the i-th word is keyed by (doc, position - i):
+    # the keys shared by all the words are where the phrase starts.
+    occurrences = [_postings(postings, t) for t in numbers]
+    candidates = occurrences[0][0]
+    for docs, _, _ in occurrences[1:]:
+        candidates = np.intersect1d(candidates, docs, assume_unique=True)
+
+    starts = None
+    for i, (_, pos_docs, positions) in enumerate(occurrences):
+        keep = np.isin(pos_docs, candidates)
+        keys = ((pos_docs[keep].astype(np.int64) << 32)
+                + positions[keep] - i)
+        starts = keys if starts is None else np.intersect1d(
+            starts, keys, assume_unique=True)
+    return np.unique(starts >> 32).astype(np.int32)
+
+
+def _prefix_docs(index, postings, prefix):
+    """Docs with any word starting with prefix."""
+    lo = np.searchsorted(index["terms"], prefix)
+    hi = np.searchsorted(index["terms"], prefix + "\U0010ffff")
+    start, end = postings["term_ptr"][lo], postings["term_ptr"][hi]
+    return np.unique(postings["docs"][start:end])
+
+
+def _evaluate(index, tree, fields):
+    """Sorted doc numbers matching a parsed query, in any of the fields."""
+    kind = tree[0]
+    if kind == "and":
+        return np.intersect1d(_evaluate(index, tree[1], fields),
+                              _evaluate(index, tree[2], fields),
+                              assume_unique=True)
+    if kind == "or":
+        return np.union1d(_evaluate(index, tree[1], fields),
+                          _evaluate(index, tree[2], fields))
+    if kind == "not":
+        everything = np.arange(len(index["event_ids"]), dtype=np.int32)
+        return np.setdiff1d(everything, _evaluate(index, tree[1], fields),
+                            assume_unique=True)
+
+    # a phrase or prefix matches if it is in the narrative or the cause
+    match = _phrase_docs if kind == "phrase" else _prefix_docs
+    docs = [match(index, index["fields"][field], tree[1]) for field in fields]
+    return np.unique(np.concatenate(docs))
+
+
+def _filter_mask(xml_df, filters):
+    """Rows of xml_df with each column equal to (or in a list of) values."""
+    mask = np.ones(len(xml_df), dtype=bool)
+    for col, value in filters.items():
+        values = [value] if isinstance(value, str) else list(np.atleast_1d(
+            value))
+        mask &= xml_df[col].isin(values).to_numpy()
+    return mask
+
+
+def search(index, query, field="all", xml_df=None, **filters):
+    """EventIds whose narrative (or cause) matches a query."""
+    # field is "narrative", "cause" or "all". Keyword filters on xml_df
+    # columns, e.g. Country="Brazil" or Make=["ROBINSON", "Robinson"],
+    # keep only the matching events that are in those rows.
+    fields = list(search_fields) if field == "all" else [field]
+    docs = _evaluate(index, parse_query(query), fields)
+    event_ids = np.unique(index["event_ids"][docs])
+
+    if filters:
+        if xml_df is None:
+            raise ValueError("xml_df is needed to filter by {}".format(
+                ", ".join(filters)))
+        rows = xml_df["EventId"].to_numpy()[_filter_mask(xml_df, filters)]
+        event_ids = event_ids[np.isin(event_ids, rows.astype(str))]
+    return event_ids
+
+
+def match_rate(index, query, xml_df, by, field="all", **filters):
+    """Events with a narrative, and the share matching a query, by group."""
+    # e.g. is "mast bumping" more common in Brazilian helicopter accidents
+    # than in all helicopter accidents?
+    by = [by] if isinstance(by, str) else list(by)
+    events = xml_df.loc[_filter_mask(xml_df, filters), ["EventId"] + by]
+    events = events.drop_duplicates()
+    events = events[events["EventId"].isin(index["event_ids"])]
+    events["matches"] = events["EventId"].isin(search(index, query, field))
+
+    rates = events.groupby(by, observed=True).agg(
+        events=("matches", "size"), matches=("matches", "sum"))
+    rates["per_match"] = rates["matches"] / rates["events"]
+    return rates.sort_values("events", ascending=False)
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Shared summary statistics for the NTSB aviation data
+
+@author: allisonyoung
+"""
+############################################################
+#### File Summary ##########################################
+############################################################
+#
+# This module takes as inputs,
+# 1) the cleaned xml_df pandas dataframe (see ntsb_data.py),
+# with the Fatality_bin outcome column
+#
+# Processes includes:
+#  A) fatality rates by the values of any number of predictor
+#     columns, in a single grouped pass
+#  B) a profile of every column (count, unique, top, freq, missing,
+#     blank), for the full data and any subsets of it, which can be
+#     saved as json or parquet
+#  C) a report of the memory saved, and the groupby time saved, by
+#     storing the text fields as categoricals
+#
+# Usage:
+#  from ntsb_stats import fatality_rates, profile_columns, write_profile
+#  rates = fatality_rates(mod_df, ["NumberOfEngines", "AmateurBuilt"])
+#  print(rates.loc["NumberOfEngines"])
+#  profile = profile_columns(xml_df, {"nuncf": nuncf})
+#  write_profile(profile, "./data/cache/profile.json")
+#
+
+##########################################################
+#### CODE ################################################
+##########################################################
+## Import Files
+import os
+import time
+import numpy as np
+import pandas as pd
+
+
+##########################################################
+### Fatality rates by predictor
+##########################################################
+
+def wilson_interval(successes, totals, z=1.96):
+    """Wilson score interval for a proportion, as (low, high) arrays."""
+    successes = np.asarray(successes, dtype=float)
+    totals = np.asarray(totals, dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        p = successes / totals
+        denom = 1 + z ** 2 / totals
+        centre = (p + z ** 2 / (2 * totals)) / denom
+        half = z * np.sqrt(p * (1 - p) / totals
+                           + z ** 2 / (4 * totals ** 2)) / denom
+    return centre - half, centre + half
+
+
+def fatality_rates(df, cols, outcome="Fatality_bin", z=1.96):
+    """Fatal counts, fatality rate and its 95% CI for each value of cols."""
+    # Stack the predictor columns into one long (variable, value) table,
+    # so every column is counted in the same groupby, instead of a
+    # filtered groupby for the fatal and the non-fatal rows of each.
+    long_df = df[cols].astype(object).melt(var_name="variable",
+                                           value_name="value")
+    long_df["fatal"] = np.tile((df[outcome] == "Fatal").to_numpy(), len(cols))
+    long_df["known"] = np.tile(df[outcome].notna().to_numpy(), len(cols))
+    long_df = long_df[long_df["known"] & long_df["value"].notna()]
+
+    rates = long_df.groupby(["variable", "value"]).agg(
+        accidents=("fatal", "size"), fatal=("fatal", "sum"))
+    rates["fatal"] = rates["fatal"].astype(int)
+    rates["non_fatal"] = rates["accidents"] - rates["fatal"]
+    rates["per_fatal"] = rates["fatal"] / rates["accidents"]
+    rates["ci_low"], rates["ci_high"] = wilson_interval(rates["fatal"],
+                                                        rates["accidents"], z)
+
+    # keep the columns in the order they were asked for
+    order = pd.Categorical(rates.index.get_level_values("variable"),
+                           categories=cols)
+    return rates.iloc[np.argsort(order.codes, kind="stable")]
+
+
+##########################################################
+### Column profiles
+##########################################################
+
+## statistics reported for each column
+profile_stats = ["count", "unique", "top", "freq", "missing", "blank"]
+
+
+def _subset_mask(df, subset):
+    """Boolean row mask for a subset given as a mask or a dataframe."""
+    if isinstance(subset, pd.DataFrame):
+        # a subset that isn't indexed like df (e.g. after reset_index)
+        # would silently pick the wrong rows
+        missing = ~subset.index.isin(df.index)
+        if missing.any():
+            raise ValueError("{} rows of the subset aren't rows of df"
+                             .format(missing.sum()))
+        return df.index.isin(subset.index)
+    return np.asarray(subset, dtype=bool)
+
+
+def profile_columns(df, subsets=None):
+    """Profile every column of df, and of each named subset of its rows."""
+    # subsets is a dict of name -> boolean mask (or a dataframe taken from
+    # df, such as nuncf), the full data is always profiled as "all"
+    masks = {"all": np.ones(len(df), dtype=bool)}
+    for name, subset in (subsets or {}).items():
+        masks[name] = _subset_mask(df, subset)
+
+    rows = []
+    for col in df.columns:
+        # Code each column once. Every statistic, for every subset, is then
+        # a count of those integer codes, rather than a describe() of
+        # the strings.
+        codes, uniques = pd.factorize(df[col], use_na_sentinel=True)
+        uniques = pd.Index(uniques)
+        is_blank = np.array([isinstance(u, str) and not u.strip()
+                             for u in uniques], dtype=bool)
+
+        for name, mask in masks.items():
+            sub_codes = codes[mask]
+            missing = int((sub_codes == -1).sum())
+            counts = np.bincount(sub_codes[sub_codes >= 0],
+                                 minlength=len(uniques))
+            top = counts.argmax() if counts.any() else None
+            rows.append({
+                "subset": name,
+                "column": col,
+                "count": int(counts.sum()),
+                "unique": int((counts > 0).sum()),
+                "top": None if top is None else str(uniques[top]),
+                "freq": 0 if top is None else int(counts[top]),
+                "missing": missing,
+                "blank": int(counts[is_blank].sum()),
+            })
+
+    return pd.DataFrame(rows).set_index(["subset", "column"])[profile_stats]
+
+
+def write_profile(profile, path):
+    """Save a profile as .json (records) or .parquet, by file extension."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    if path.endswith(".parquet"):
+        profile.to_parquet(path)
+    else:
+        profile.reset_index().to_json(path, orient="records", indent=1)
+    return path
+
+
+##########################################################
+### Categorical encoding report
+##########################################################
+
+## the groupings used for the case study in 6_NUSNCF_CaseStudy.py
+case_study_groups = ["Country", "Make", ["Make", "Model"],
+                     ["PurposeOfFlight", "Make"], "BroadPhaseOfFlight",
+                     "AircraftCategory"]
+
+
+def _best_time(func, repeat):
+    """Fastest of repeat runs of func, in seconds."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def categorical_report(xml_df, groups=case_study_groups,
+                       value="TotalFatalInjuries", repeat=5):
+    """Memory and groupby time of the categorical columns vs plain strings."""
+    cat_cols = [i for i in xml_df.columns
+                if isinstance(xml_df[i].dtype, pd.CategoricalDtype)]
+    plain_df = xml_df.copy()
+    for i in cat_cols:
+        plain_df[i] = plain_df[i].astype(object)
+
+    memory = pd.DataFrame({
+        "string_bytes": plain_df[cat_cols].memory_usage(index=False, deep=True),
+        "categorical_bytes": xml_df[cat_cols].memory_usage(index=False,
+                                                           deep=True)})
+    memory.loc["Total"] = memory.sum()
+    memory["saved"] = 1 - memory["categorical_bytes"] / memory["string_bytes"]
+
+    timing = []
+    for keys in groups:
+        plain = _best_time(lambda: plain_df.groupby(keys)[value].sum(), repeat)
+        cat = _best_time(lambda: xml_df.groupby(keys, observed=True)[value]
+                         .sum(), repeat)
+        timing.append({"groupby": " + ".join(np.atleast_1d(keys)),
+                       "string_secs": plain, "categorical_secs": cat,
+                       "speedup": plain / cat})
+    return memory, pd.DataFrame(timing).set_index("groupby")
@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Shared text processing for the NTSB narratives
+
+@author: allisonyoung
+"""
+############################################################
+#### File Summary ##########################################
+############################################################
+#
+# This module takes as inputs,
+# 1) narrative (or probable cause) text, such as the Narrative
+# column from load_narratives / get_narratives (see ntsb_narratives.py)
+#
+# Processes includes:
+#  A) learning the boilerplate sentences repeated across the narratives
+#     (such as "NTSB investigators may not have traveled in support of
+#     this investigation...") and stripping them from the text
+#  B) tokenizing the text and removing stop words, in chunks of
+#     narratives spread over worker processes
+#  C) counting the tokens into a sparse term-document matrix, and
+#     finding the most frequent terms
+#
+# Usage:
+#  from ntsb_text import learn_boilerplate, term_document_matrix, top_terms
+#  boilerplate = learn_boilerplate(master_json["Narrative"])
+#  counts, vocab = term_document_matrix(master_json["Narrative"],
+#                                       boilerplate=boilerplate)
+#  print(top_terms(counts, vocab, 25))
+#
+
+##########################################################
+#### CODE ################################################
+##########################################################
+## Import Files
+import hashlib
+import json
+import os
+import re
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from ntsb_narratives import _pool_context
+
+## words, numbers and hyphenated words such as go-around or pr-ito.
+## Punctuation is dropped, and run-on sentences such as
+## "information.On" are split into two words.
+token_pattern = re.compile(r"[^\W_]+(?:[-'][^\W_]+)*")
+
+## narratives per chunk handed to a worker process
+chunk_size = 2000
+
+## sentence ends: ., ! or ? followed by a capital letter. The narratives
+## often run sentences together ("...aircraft accident report.During the
+## flight"), so the space after the period is optional.
+sentence_end = re.compile(r"[.!?]\s*(?=[A-Z])")
+_digit = re.compile(r"\d")
+_non_word = re.compile(r"[^\w#]+")
+
+
+##########################################################
+### Stop words
+##########################################################
+
+_english_stopwords = None
+
+
+def english_stopwords():
+    """NLTK's English stop words, as a frozenset (loaded once)."""
+    # needs the nltk stopwords corpus: nltk.download('stopwords')
+    global _english_stopwords
+    if _english_stopwords is None:
+        from nltk.corpus import stopwords
+        _english_stopwords = frozenset(stopwords.words('english'))
+    return _english_stopwords
+
+
+def make_stop_words(extra=(), base=None):
+    """Frozen set of stop words, English plus any extra (boilerplate) words."""
+    base = english_stopwords() if base is None else base
+    return frozenset(base) | frozenset(w.lower() for w in extra)
+
+
+##########################################################
+### Worker processes
+##########################################################
+
+def map_chunks(func, texts, processes, *args):
+    """Run func over (chunk of texts, *args), in order, in a process pool."""
+    texts = list(texts)
+    chunks = [(texts[i:i + chunk_size],) + args
+              for i in range(0, len(texts), chunk_size)]
+    ctx = _pool_context()
+    processes = processes or os.cpu_count() or 1
+
+    if ctx is None or processes == 1 or len(chunks) < 2:
+        yield from map(func, chunks)
+        return
+
+    with ctx.Pool(min(processes, len(chunks))) as pool:
+        yield from pool.imap(func, chunks)
+
+
+##########################################################
+### Boilerplate sentences
+##########################################################
+
+def split_sentences(text):
+    """Split a narrative into sentences, keeping the original text."""
+    # joining the pieces back together gives the narrative unchanged
+    pieces, start = [], 0
+    for m in sentence_end.finditer(text):
+        pieces.append(text[start:m.end()])
+        start = m.end()
+    pieces.append(text[start:])
+    return [p for p in pieces if p]
+
+
+def _sentence_key(sentence):
+    """Hash of a sentence with case, numbers, spacing and punctuation removed."""
+    words = _non_word.sub(" ", _digit.sub("#", sentence.lower())).split()
+    normal = " ".join(words)
+    key = hashlib.blake2b(normal.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(key, "little"), normal, len(words)
+
+
+def _count_sentences_chunk(args):
+    """Narrative count of each long sentence in one chunk (worker process)."""
+    texts, min_words = args
+    doc_counts = {}
+    for text in texts:
+        if not isinstance(text, str):
+            continue
+        keys = set()
+        for sentence in split_sentences(text):
+            key, normal, num_words = _sentence_key(sentence)
+            if num_words >= min_words:
+                keys.add(key)
+        for key in keys:
+            doc_counts[key] = doc_counts.get(key, 0) + 1
+    return doc_counts
+
+
+def learn_boilerplate(texts, min_fraction=0.005, min_words=6, processes=None):
+    """Sentences found in at least min_fraction of the narratives."""
+    # Count how many narratives each (normalized) sentence is in, keyed by
+    # a 64 bit hash so only one number per distinct sentence is kept. The
+    # preambles repeat in thousands of narratives while ordinary sentences
+    # rarely repeat; min_words keeps short common sentences such as
+    # "There was no fire." out of the boilerplate.
+    texts = [t for t in texts if isinstance(t, str)]
+    doc_counts = {}
+    for chunk_counts in map_chunks(_count_sentences_chunk, texts, processes,
+                                    min_words):
+        for key, count in chunk_counts.items():
+            doc_counts[key] = doc_counts.get(key, 0) + count
+
+    min_docs = max(2, int(min_fraction * len(texts)))
+    return {key: count for key, count in doc_counts.items()
+            if count >= min_docs}
+
+
+def strip_boilerplate(text, boilerplate):
+    """Remove the boilerplate sentences from a narrative."""
+    if not isinstance(text, str) or not boilerplate:
+        return text
+    return "".join(s for s in split_sentences(text)
+                   if _sentence_key(s)[0] not in boilerplate)
+
+
+def boilerplate_examples(texts, boilerplate):
+    """Example text and narrative count of each boilerplate sentence."""
+    examples = {}
+    for text in texts:
+        if not isinstance(text, str):
+            continue
+        for sentence in split_sentences(text):
+            key = _sentence_key(sentence)[0]
+            if key in boilerplate and key not in examples:
+                examples[key] = sentence.strip()
+        if len(examples) == len(boilerplate):
+            break
+    return pd.Series({examples[k]: n for k, n in boilerplate.items()
+                      if k in examples}, name="narratives").sort_values(
+                          ascending=False)
+
+
+def save_boilerplate(boilerplate, path):
+    """Save learned boilerplate (sentence hash -> narrative count) as json."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as f:
+        json.dump({str(k): v for k, v in boilerplate.items()}, f)
+    return path
+
+
+def load_boilerplate(path):
+    """Load boilerplate saved by save_boilerplate."""
+    with open(path) as f:
+        return {int(k): v for k, v in json.load(f).items()}
+
+
+##########################################################
+### Tokenize
+##########################################################
+
+def tokenize(text, stop_words=frozenset(), boilerplate=None):
+    """Lowercase a narrative and split it into tokens, minus stop words."""
+    if not isinstance(text, str):
+        return []
+    text = strip_boilerplate(text, boilerplate)
+    return [w for w in token_pattern.findall(text.lower())
+            if w not in stop_words]
+
+
+def _tokenize_chunk(args):
+    """Tokenize one chunk of narratives (run in a worker process)."""
+    texts, stop_words, boilerplate = args
+    return [tokenize(text, stop_words, boilerplate) for text in texts]
+
+
+def add_ngrams(tokens, ngrams):
+    """Add the 2..ngrams word phrases (e.g. 'mast bumping') to a token list."""
+    terms = list(tokens)
+    for n in range(2, ngrams + 1):
+        terms.extend(" ".join(tokens[i:i + n])
+                     for i in range(len(tokens) - n + 1))
+    return terms
+
+
+def _count_chunk(args):
+    """Count the tokens of one chunk of narratives (run in a worker process)."""
+    # Returns the chunk's own vocabulary and a sparse count matrix against
+    # it, which is much smaller to send back than the token lists.
+    texts, stop_words, boilerplate, ngrams = args
+    vocab = {}
+    indptr, indices = [0], []
+    for text in texts:
+        tokens = tokenize(text, stop_words, boilerplate)
+        if ngrams > 1:
+            tokens = add_ngrams(tokens, ngrams)
+        for w in tokens:
+            indices.append(vocab.setdefault(w, len(vocab)))
+        indptr.append(len(indices))
+    counts = sparse.csr_matrix(
+        (np.ones(len(indices), dtype=np.int32), indices, indptr),
+        shape=(len(texts), len(vocab)))
+    counts.sum_duplicates()
+    return list(vocab), counts
+
+
+def tokenize_narratives(texts, stop_words=None, boilerplate=None,
+                        processes=None):
+    """Token list for each narrative, tokenized in parallel chunks."""
+    stop_words = english_stopwords() if stop_words is None else stop_words
+    tokens = []
+    for chunk_tokens in map_chunks(_tokenize_chunk, texts, processes,
+                                    stop_words, boilerplate):
+        tokens.extend(chunk_tokens)
+    return tokens
+
+
+##########################################################
+### Term-document matrix and term frequencies
+##########################################################
+
+def term_document_matrix(texts, stop_words=None, boilerplate=None,
+                         processes=None, ngrams=1):
+    """Sparse narratives x terms count matrix, and the terms (its columns)."""
+    # with ngrams=2 the terms include two word phrases, such as
+    # 'mast bumping', as well as single words
+    stop_words = english_stopwords() if stop_words is None else stop_words
+    vocab = {}
+    blocks = []
+    for chunk_vocab, counts in map_chunks(_count_chunk, texts, processes,
+                                           stop_words, boilerplate, ngrams):
+        # move the chunk's term numbers onto the combined vocabulary
+        ids = np.array([vocab.setdefault(w, len(vocab)) for w in chunk_vocab],
+                       dtype=np.int64)
+        counts = counts.tocoo()
+        blocks.append((counts.shape[0], ids[counts.col], counts.row,
+                       counts.data))
+
+    rows, cols, data = [], [], []
+    offset = 0
+    for num_rows, block_cols, block_rows, block_data in blocks:
+        rows.append(block_rows + offset)
+        cols.append(block_cols)
+        data.append(block_data)
+        offset += num_rows
+
+    if blocks:
+        data, rows, cols = (np.concatenate(data), np.concatenate(rows),
+                            np.concatenate(cols))
+    matrix = sparse.csr_matrix((data, (rows, cols)), shape=(offset, len(vocab)),
+                               dtype=np.int32)
+    return matrix, np.array(list(vocab), dtype=object)
+
+
+def top_terms(matrix, vocab, n=25):
+    """The n most frequent terms in a term-document matrix, with counts."""
+    totals = np.asarray(matrix.sum(axis=0)).ravel()
+    top = np.argsort(-totals, kind="stable")[:n]
+    return pd.Series(totals[top], index=vocab[top], name="count")
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Term frequencies over time in the NTSB narratives
+
+@author: allisonyoung
+"""
+############################################################
+#### File Summary ##########################################
+############################################################
+#
+# This module takes as inputs,
+# 1) the xml_df pandas dataframe (see ntsb_data.py), for the EventDate
+# of each EventId
+# 2) Data in .json format from the incident narratives
+#
+# Processes includes:
+#  A) counting the words and two word phrases of the narratives by year
+#     (or month) of the event, saved as one sparse count matrix per
+#     narrative file in ./data/cache/term_index
+#  B) updating that index when narrative files are added or changed,
+#     counting only those files again
+#  C) looking up the frequency of any word or phrase over time
+#
+# Usage:
+#  from ntsb_trends import update_term_index, term_trend
+#  index = update_term_index(xml_df, "./data")
+#  print(term_trend(index, ["mast bumping", "fuel exhaustion"]))
+#
+
+##########################################################
+#### CODE ################################################
+##########################################################
+## Import Files
+import hashlib
+import json
+import os
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from ntsb_narratives import (file_number, find_narrative_files,
+                             narrative_file_keys, path_to_data_dir,
+                             read_narrative_files)
+from ntsb_text import english_stopwords, term_document_matrix, tokenize
+
+## default index folder, relative to the repository root
+path_to_term_index = "./data/cache/term_index"
+
+## narrative files counted together when building the index
+files_per_batch = 20
+
+
+##########################################################
+### Event dates
+##########################################################
+
+def event_periods(xml_df, period="year"):
+    """Year ('2015') or month ('2015-07') of each EventId, from EventDate."""
+    dates = xml_df["EventDate"]
+    if not pd.api.types.is_datetime64_any_dtype(dates):
+        # dates are entered in the format MM/DD/YYYY
+        dates = pd.to_datetime(dates, format="%m/%d/%Y", errors="coerce")
+    labels = dates.dt.strftime("%Y" if period == "year" else "%Y-%m")
+    periods = pd.Series(labels.to_numpy(), index=xml_df["EventId"].to_numpy())
+    periods = periods[periods.notna()]
+    return periods[~periods.index.duplicated()]
+
+
+def _hash_of(values):
+    """Short sha1 of a list of strings, to tell when settings change."""
+    sha = hashlib.sha1()
+    for value in values:
+        sha.update(str(value).encode("utf-8") + b"\n")
+    return sha.hexdigest()
+
+
+##########################################################
+### Build and update the index
+##########################################################
+
+def _load_meta(index_dir):
+    """Index settings and file list, or None if the index isn't built."""
+    meta_path = os.path.join(index_dir, "meta.json")
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as f:
+        meta = json.load(f)
+    # the vocabulary is kept as one term per line, next to meta.json
+    with open(os.path.join(index_dir, "vocab.txt"), encoding="utf-8") as f:
+        meta["vocab"] = f.read().split("\n")[:-1]
+    return meta
+
+
+def _save_meta(meta, index_dir):
+    """Write the settings, file list and vocabulary of the index."""
+    with open(os.path.join(index_dir, "vocab.txt"), "w",
+              encoding="utf-8") as f:
+        f.writelines(w + "\n" for w in meta["vocab"])
+    with open(os.path.join(index_dir, "meta.json"), "w") as f:
+        json.dump({k: v for k, v in meta.items() if k != "vocab"}, f)
+
+
+def update_term_index(xml_df, data_dir=path_to_data_dir,
+                      index_dir=path_to_term_index, stop_words=None,
+                      boilerplate=None, period="year", ngrams=2,
+                      processes=None):
+    """Count new or changed narrative files into the index, and load it."""
+    stop_words = english_stopwords() if stop_words is None else stop_words
+    periods = event_periods(xml_df, period)
+    settings = {
+        "period": period,
+        "ngrams": ngrams,
+        "stop_words": sorted(stop_words),
+        "boilerplate": _hash_of(sorted(boilerplate or {})),
+        # if the event dates change, every file has to be counted again
+        "dates": _hash_of(periods.index + "=" + periods.to_numpy()),
+    }
+
+    meta = _load_meta(index_dir)
+    if meta is None or meta["settings"] != settings:
+        meta = {"settings": settings, "vocab": [], "files": {}}
+    os.makedirs(index_dir, exist_ok=True)
+
+    # find the files that are new or changed since they were counted
+    paths = {str(file_number(p)): p for p in find_narrative_files(data_dir)}
+    current = {fnum: (paths[fnum], size, mtime) for fnum, (size, mtime)
+               in narrative_file_keys(data_dir).items() if fnum in paths}
+    changed = [path for fnum, (path, size, mtime) in current.items()
+               if meta["files"].get(fnum, {}).get("key") != [size, mtime]]
+    removed = [fnum for fnum in meta["files"] if fnum not in current]
+
+    if changed or removed or not os.path.exists(
+            os.path.join(index_dir, "combined.npz")):
+        for fnum in removed:
+            os.remove(os.path.join(index_dir, "{}.npz".format(fnum)))
+            del meta["files"][fnum]
+        # count the files in batches, to bound the memory used for the
+        # two word phrases of the first full build
+        for start in range(0, len(changed), files_per_batch):
+            _count_files(changed[start:start + files_per_batch], current,
+                         periods, meta, index_dir, stop_words, boilerplate,
+                         ngrams, processes)
+        _combine_files(meta, index_dir)
+        _save_meta(meta, index_dir)
+
+    return load_term_index(index_dir)
+
+
+def _count_files(paths, current, periods, meta, index_dir, stop_words,
+                 boilerplate, ngrams, processes):
+    """Count the narratives of some files by period, one matrix per file."""
+    # read the files, keeping only narratives with a known event date
+    file_rows, texts, labels = [], [], []
+    for fnum, ids, narrative, cause in read_narrative_files(paths, processes):
+        dated = periods.reindex(ids)
+        keep = dated.notna().to_numpy()
+        file_rows.append((fnum, keep.sum()))
+        texts.extend(np.asarray(narrative, dtype=object)[keep])
+        labels.extend(dated[keep])
+
+    # the files are tokenized together, in parallel chunks
+    counts, file_vocab = term_document_matrix(texts, stop_words, boilerplate,
+                                              processes, ngrams)
+    vocab_ids = {w: i for i, w in enumerate(meta["vocab"])}
+    for w in file_vocab:
+        if w not in vocab_ids:
+            vocab_ids[w] = len(meta["vocab"])
+            meta["vocab"].append(w)
+    global_cols = np.array([vocab_ids[w] for w in file_vocab], dtype=np.int64)
+    labels = np.asarray(labels, dtype=object)
+
+    start = 0
+    for fnum, num_rows in file_rows:
+        rows = slice(start, start + num_rows)
+        start += num_rows
+
+        # sum the narratives of each period, with a periods x narratives
+        # indicator matrix, then move the columns onto the index vocabulary
+        file_periods, period_of_row = np.unique(labels[rows],
+                                                return_inverse=True)
+        indicator = sparse.csr_matrix(
+            (np.ones(num_rows), (period_of_row, np.arange(num_rows))),
+            shape=(len(file_periods), num_rows))
+        by_period = (indicator @ counts[rows]).tocoo()
+        by_period = sparse.csr_matrix(
+            (by_period.data, (by_period.row, global_cols[by_period.col])),
+            shape=(len(file_periods), len(meta["vocab"])), dtype=np.int64)
+
+        sparse.save_npz(os.path.join(index_dir, "{}.npz".format(fnum)),
+                        by_period)
+        _, size, mtime = current[str(fnum)]
+        meta["files"][str(fnum)] = {"key": [size, mtime],
+                                    "periods": list(file_periods)}
+
+
+def _combine_files(meta, index_dir):
+    """Add up the per-file counts into one periods x terms matrix."""
+    all_periods = sorted({p for entry in meta["files"].values()
+                          for p in entry["periods"]})
+    period_ids = {p: i for i, p in enumerate(all_periods)}
+
+    empty = np.zeros(0, dtype=np.int64)
+    rows, cols, data = [empty], [empty], [empty]
+    for fnum, entry in meta["files"].items():
+        file_counts = sparse.load_npz(
+            os.path.join(index_dir, "{}.npz".format(fnum))).tocoo()
+        file_rows = np.array([period_ids[p] for p in entry["periods"]])
+        rows.append(file_rows[file_counts.row])
+        cols.append(file_counts.col)
+        data.append(file_counts.data)
+
+    # repeated (period, term) pairs are summed when the matrix is built
+    counts = sparse.csr_matrix(
+        (np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(len(all_periods), len(meta["vocab"])), dtype=np.int64)
+    sparse.save_npz(os.path.join(index_dir, "combined.npz"), counts)
+    meta["periods"] = all_periods
+
+    # number of single words counted in each period, to turn counts to rates
+    is_word = np.array([" " not in w for w in meta["vocab"]], dtype=bool)
+    meta["words"] = np.asarray(counts[:, is_word].sum(axis=1)).ravel().tolist()
+
+
+##########################################################
+### Load and query the index
+##########################################################
+
+def load_term_index(index_dir=path_to_term_index):
+    """Load the periods x terms count matrix of the index."""
+    meta = _load_meta(index_dir)
+    vocab = np.array(meta["vocab"], dtype=object)
+    counts = sparse.load_npz(os.path.join(index_dir, "combined.npz")).tocsc()
+
+    return {"periods": pd.Index(meta["periods"],
+                                name=meta["settings"]["period"]),
+            "vocab": vocab,
+            "vocab_ids": {w: i for i, w in enumerate(vocab)},
+            "counts": counts,
+            "words": np.array(meta["words"]),
+            "settings": meta["settings"]}
+
+
+def term_trend(index, terms, per=None):
+    """Count of each term (or phrase) per period, or its rate per `per` words."""
+    stop_words = frozenset(index["settings"]["stop_words"])
+    trend = {}
+    for term in terms:
+        # look the phrase up the way the narratives were tokenized
+        key = " ".join(tokenize(term, stop_words))
+        if len(key.split()) > index["settings"]["ngrams"]:
+            raise ValueError("'{}' is longer than the {} word phrases in the "
+                             "index".format(term, index["settings"]["ngrams"]))
+        col = index["vocab_ids"].get(key)
+        if col is None:
+            values = np.zeros(len(index["periods"]))
+        else:
+            values = index["counts"][:, col].toarray().ravel()
+        trend[term] = values
+
+    trend = pd.DataFrame(trend, index=index["periods"])
+    if per:
+        trend = trend.div(index["words"], axis=0) * per
+    return trend